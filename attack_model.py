@@ -62,6 +62,7 @@ parser.add_argument('--threshold', type=float, default=.7)
 parser.add_argument('--debug',  action='store_true')
 parser.add_argument('--no_random_start',  action='store_true')
 parser.add_argument("--load_path", type=str, default=None)
+parser.add_argument("--scripted", action="store_true", help="load_path is a standalone TorchScript model from export_model.py")
 parser.add_argument("--distance", type=str, default='Linf')
 parser.add_argument("--n_steps_pgd_attack", type=int, default=40)
 parser.add_argument("--start_batch", type=int, default=-1)
@@ -146,16 +147,20 @@ class CCF(F):
             return torch.gather(logits, 1, y[:, None])
 
 # construct model and ship to GPU
-f = CCF(args.depth, args.width, args.norm)
 print(args.load_path)
-print("loading model from {args.load_path}")
-ckpt_dict = torch.load(args.load_path)
-if "model_state_dict" in ckpt_dict:
-    # loading from a new checkpoint
-    f.load_state_dict(ckpt_dict["model_state_dict"])
+if args.scripted:
+    # standalone model from export_model.py, no class definition or state dict needed
+    f = torch.jit.load(args.load_path, map_location="cpu")
 else:
-    # loading from an old checkpoint
-    f.load_state_dict(ckpt_dict)
+    f = CCF(args.depth, args.width, args.norm)
+    print("loading model from {args.load_path}")
+    ckpt_dict = torch.load(args.load_path)
+    if "model_state_dict" in ckpt_dict:
+        # loading from a new checkpoint
+        f.load_state_dict(ckpt_dict["model_state_dict"])
+    else:
+        # loading from an old checkpoint
+        f.load_state_dict(ckpt_dict)
 
 # wrapper class to provide utilities for what you need
 class DummyModel(nn.Module):
@@ -0,0 +1,81 @@
+import argparse
+import time
+import torch as t
+from replay_buffer import ReplayBuffer, QuantizedReplayBuffer, load_buffer_state
+
+
+def init_uniform(shape):
+    return lambda bs, device: t.empty((bs,) + shape, device=device).uniform_(-1, 1)
+
+
+def get_samples(args):
+    if args.load_path is not None:
+        # real chains from a trained model's replay buffer
+        samples = load_buffer_state(t.load(args.load_path, map_location="cpu")["replay_buffer"])
+        return samples[:args.buffer_size].float()
+    # stand-in for SGLD chains: uniform init plus accumulated gaussian noise
+    shape = (args.buffer_size,) + tuple(args.sample_shape)
+    return t.empty(shape).uniform_(-1, 1) + args.noise * t.randn(shape)
+
+
+def bench(name, rb, samples, args, device):
+    bytes_per_row = sum(v.element_size() * v[0].numel() for v in [rb.buffer] + [
+        getattr(rb, a) for a in ("scale", "offset") if hasattr(rb, a)])
+
+    # sample quality: round trip every row through the storage format
+    inds = t.arange(len(rb), device=rb.device)
+    err = (rb.read(inds).cpu() - samples).view(len(rb), -1)
+    rmse = err.pow(2).mean().sqrt().item()
+    max_err = err.abs().max().item()
+
+    # throughput: one sample_p_0 + write-back per iteration, as in sample_q
+    def step():
+        x, inds, _ = rb.sample(args.batch_size)
+        rb.write(inds, x.to(device))
+    for _ in range(10):
+        step()
+    if device.type == "cuda":
+        t.cuda.synchronize()
+    start = time.time()
+    for _ in range(args.n_iters):
+        step()
+    if device.type == "cuda":
+        t.cuda.synchronize()
+    rows_per_sec = args.n_iters * args.batch_size / (time.time() - start)
+
+    print("{:>8s} | {:>8d} bytes/row | rmse={:.6f} max_err={:.6f} | {:>12.0f} rows/s".format(
+        name, bytes_per_row, rmse, max_err, rows_per_sec))
+
+
+def main(args):
+    t.manual_seed(args.seed)
+    device = t.device('cuda' if t.cuda.is_available() else 'cpu')
+    buffer_device = device if args.buffer_backend == "device" else t.device("cpu")
+    samples = get_samples(args)
+    init_fn = init_uniform(tuple(samples.shape[1:]))
+    print("buffer {} on {}".format(tuple(samples.shape), buffer_device))
+    for storage in args.storage:
+        if storage == "float32":
+            rb = ReplayBuffer(samples.clone(), init_fn, reinit_freq=args.reinit_freq, device=buffer_device)
+        else:
+            rb = QuantizedReplayBuffer(samples, init_fn, reinit_freq=args.reinit_freq, device=buffer_device,
+                                       storage=storage)
+        bench(storage, rb, samples, args, device)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser("Replay buffer storage benchmark")
+    parser.add_argument("--storage", nargs="+", type=str, default=["float32", "float16", "uint8"])
+    parser.add_argument("--buffer_backend", type=str, default="device", choices=["device", "cpu"])
+    parser.add_argument("--buffer_size", type=int, default=10000)
+    parser.add_argument("--sample_shape", nargs="+", type=int, default=[3, 32, 32])
+    parser.add_argument("--noise", type=float, default=.1, help="stddev of noise added to synthetic samples")
+    parser.add_argument("--load_path", type=str, default=None,
+                        help="If set, benchmark on the replay buffer saved in this checkpoint")
+    parser.add_argument("--batch_size", type=int, default=100)
+    parser.add_argument("--reinit_freq", type=float, default=.05)
+    parser.add_argument("--n_iters", type=int, default=1000)
+    parser.add_argument("--seed", type=int, default=1)
+
+    args = parser.parse_args()
+    main(args)
@@ -0,0 +1,137 @@
+import itertools
+import os
+import random
+import tempfile
+import numpy as np
+import torch as t
+
+
+def dataset_labels(dset):
+    """All labels of a dataset as a numpy array, read from its label array when it has one
+    (torchvision targets/labels, TensorDataset tensors) instead of through __getitem__, which
+    would run the whole transform pipeline per example.
+    """
+    for name in ("targets", "labels"):
+        labels = getattr(dset, name, None)
+        if labels is not None:
+            return np.asarray(labels.cpu() if t.is_tensor(labels) else labels)
+    if isinstance(dset, t.utils.data.TensorDataset):
+        return dset.tensors[1].cpu().numpy()
+    return np.array([dset[ind][1] for ind in range(len(dset))])
+
+
+def get_split_inds(dset, seed, n_valid=None, labels_per_class=0, n_classes=10, cache_path=None):
+    """Shuffles the training set with seed and splits it into (train, valid, train_labeled)
+    indices, keeping the first labels_per_class examples of each class as the labeled set.
+
+    If cache_path is given the split is saved there and reused by later runs with the same
+    dataset size, seed and split sizes. The global numpy seed is set and the shuffle drawn either
+    way, so everything seeded downstream sees the same RNG state whether the cache is hit or not.
+    """
+    all_inds = list(range(len(dset)))
+    # set seed
+    np.random.seed(seed)
+    # shuffle
+    np.random.shuffle(all_inds)
+
+    if cache_path is not None and os.path.exists(cache_path):
+        cached = np.load(cache_path)
+        if int(cached["n"]) == len(dset):
+            return cached["train"], list(cached["valid"]), list(cached["train_labeled"])
+
+    # seperate out validation set
+    if n_valid is not None:
+        valid_inds, train_inds = all_inds[:n_valid], all_inds[n_valid:]
+    else:
+        valid_inds, train_inds = [], all_inds
+    train_inds = np.array(train_inds)
+    train_labeled_inds = []
+    if labels_per_class > 0:
+        train_labels = dataset_labels(dset)[train_inds]
+        for i in range(n_classes):
+            train_labeled_inds.extend(train_inds[train_labels == i][:labels_per_class])
+    else:
+        train_labeled_inds = train_inds
+
+    if cache_path is not None:
+        os.makedirs(os.path.dirname(cache_path) or ".", exist_ok=True)
+        # a unique temporary name, so concurrent writers (e.g. the ranks of a distributed run)
+        # never clobber each other's file before the atomic replace
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(cache_path) or ".", suffix=".tmp.npz")
+        with os.fdopen(fd, "wb") as f:
+            np.savez(f, n=len(dset), train=train_inds, valid=np.array(valid_inds, dtype=np.int64),
+                     train_labeled=np.array(train_labeled_inds, dtype=np.int64))
+        os.replace(tmp_path, cache_path)
+    return train_inds, valid_inds, train_labeled_inds
+
+
+def split_cache_path(root, dataset, seed, n_valid, labels_per_class):
+    return os.path.join(root, "splits", "{}_seed{}_valid{}_lpc{}.npz".format(dataset, seed, n_valid,
+                                                                             labels_per_class))
+
+
+class DatasetView(t.utils.data.Dataset):
+    """Lightweight view of a raw dataset: the examples at inds (all if None), with transform
+    applied to the inputs. Indexing with an array or slice works as on the base dataset.
+    """
+
+    def __init__(self, base_dataset, inds=None, transform=None):
+        self.base_dataset = base_dataset
+        self.inds = inds
+        self.transform = transform
+
+    def __getitem__(self, index):
+        base_ind = index if self.inds is None else self.inds[index]
+        x, y = self.base_dataset[base_ind]
+        if self.transform is not None:
+            x = self.transform(x)
+        return x, y
+
+    def __len__(self):
+        return len(self.base_dataset) if self.inds is None else len(self.inds)
+
+
+class DatasetRegistry(object):
+    """Loads each raw split once through dataset_fn(train, None) and hands out DatasetViews
+    with per-view indices and transforms, so train/labeled/valid sets share one copy in memory.
+    """
+
+    def __init__(self, dataset_fn):
+        self.dataset_fn = dataset_fn
+        self._raw = {}
+
+    def raw(self, train=True):
+        if train not in self._raw:
+            self._raw[train] = self.dataset_fn(train, None)
+        return self._raw[train]
+
+    def view(self, train=True, inds=None, transform=None):
+        return DatasetView(self.raw(train), inds=inds, transform=transform)
+
+
+def seed_worker(worker_id):
+    # torch already seeds each worker from the loader's generator; derive numpy/random from it
+    worker_seed = t.initial_seed() % 2 ** 32
+    np.random.seed(worker_seed)
+    random.seed(worker_seed)
+
+
+# numbers the loaders of a run, so each one gets its own default seed
+_loader_count = itertools.count()
+
+
+def make_loader(dataset, batch_size, shuffle=False, drop_last=False, num_workers=0, prefetch_factor=2, seed=None):
+    """DataLoader used by all training/eval scripts. Workers are started once and kept across
+    epochs (so cycle() and re-iteration don't respawn them), batches are pinned when a GPU is
+    present, and shuffling and worker RNGs are seeded from seed (default: torch's initial seed
+    plus the number of loaders made before, so e.g. the train and labeled loaders of a run
+    shuffle differently, and the same way in every run with that seed).
+    """
+    generator = t.Generator()
+    generator.manual_seed((t.initial_seed() + next(_loader_count)) % 2 ** 63 if seed is None else seed)
+    kwargs = {}
+    if num_workers > 0:
+        kwargs = dict(persistent_workers=True, prefetch_factor=prefetch_factor, worker_init_fn=seed_worker)
+    return t.utils.data.DataLoader(dataset, batch_size=batch_size, shuffle=shuffle, drop_last=drop_last,
+                                   num_workers=num_workers, pin_memory=t.cuda.is_available(),
+                                   generator=generator, **kwargs)
@@ -0,0 +1,155 @@
+import os
+import torch as t
+import torch.distributed as dist
+
+
+def init_distributed(args):
+    """Joins the process group set up by torchrun (env:// rendezvous) if args.distributed is set
+    and records args.rank / args.world_size (0 / 1 otherwise). Returns this rank's device.
+    """
+    args.rank, args.world_size = 0, 1
+    if not args.distributed:
+        return t.device('cuda' if t.cuda.is_available() else 'cpu')
+    backend = args.dist_backend or ("nccl" if t.cuda.is_available() else "gloo")
+    dist.init_process_group(backend=backend, init_method="env://")
+    args.rank, args.world_size = dist.get_rank(), dist.get_world_size()
+    if t.cuda.is_available():
+        local_rank = int(os.environ.get("LOCAL_RANK", 0))
+        t.cuda.set_device(local_rank)
+        return t.device('cuda', local_rank)
+    return t.device('cpu')
+
+
+def is_distributed():
+    return dist.is_available() and dist.is_initialized()
+
+
+def _comm_device():
+    # nccl only moves device tensors, gloo is happy with host tensors
+    if dist.get_backend() == "nccl":
+        return t.device('cuda', t.cuda.current_device())
+    return t.device('cpu')
+
+
+def shard(x, rank, world_size):
+    """This rank's slice x[rank::world_size] of a tensor, array or list of indices, cut to
+    len(x) // world_size rows so all ranks get the same number (like DistributedSampler with
+    drop_last). Ranks then run the same number of steps per epoch and their collectives line up.
+    """
+    return x[rank::world_size][:len(x) // world_size]
+
+
+def broadcast_module(m, src=0):
+    """Copies the parameters and buffers (e.g. norm running stats) of m from rank src to all ranks."""
+    if not is_distributed():
+        return
+    for x in m.state_dict().values():
+        if t.is_tensor(x):
+            x_comm = x.to(_comm_device())
+            dist.broadcast(x_comm, src)
+            x.copy_(x_comm)
+
+
+def all_reduce_grads(m):
+    """Averages the gradients of m over all ranks with one flat all-reduce. Every rank must have
+    gradients for the same parameters, i.e. run the same loss terms.
+    """
+    if not is_distributed():
+        return
+    grads = [p.grad for p in m.parameters() if p.grad is not None]
+    if len(grads) == 0:
+        return
+    flat = t.cat([g.reshape(-1) for g in grads]).to(_comm_device())
+    dist.all_reduce(flat)
+    flat /= dist.get_world_size()
+    offset = 0
+    for g in grads:
+        g.copy_(flat[offset:offset + g.numel()].view_as(g))
+        offset += g.numel()
+
+
+def interleave(shards):
+    """Inverse of shard: the full tensor from the equally sized shards of all ranks, in rank order."""
+    return t.stack(shards, 1).view(-1, *shards[0].shape[1:])
+
+
+def gather_shards(x):
+    """Reassembles the full tensor on every rank from the shards x = full[rank::world_size]."""
+    if not is_distributed():
+        return x
+    x_comm = x.contiguous().to(_comm_device())
+    parts = [t.empty_like(x_comm) for _ in range(dist.get_world_size())]
+    dist.all_gather(parts, x_comm)
+    return interleave(parts).to(x.device)
+
+
+def barrier():
+    if is_distributed():
+        dist.barrier()
+
+
+def broadcast_object(obj, src=0):
+    """Rank src's value of a picklable object (e.g. a flag decided on rank 0) on every rank."""
+    if not is_distributed():
+        return obj
+    objs = [obj]
+    dist.broadcast_object_list(objs, src)
+    return objs[0]
+
+
+class ChainExchange(object):
+    """Swaps a random fraction frac of the chains of each rank's replay buffer shard with its
+    neighbours in a ring (rank r sends to r + 1 and receives from r - 1), so chains started on
+    one rank get to mix with the data and chains of the others.
+
+    start() posts non-blocking sends and receives and returns right away; finish() waits for
+    them and writes the received chains (and their labels) into the rows that were sent, so the
+    transfer runs in the background of the training step in between. Every rank has to call
+    start() and finish() at the same iterations.
+
+    With a momentum_buffer (--use_sgld_momentum) each chain's momentum row travels with it, so
+    received chains keep their own velocity.
+    """
+
+    def __init__(self, frac, momentum_buffer=None):
+        self.frac = frac
+        self.momentum_buffer = momentum_buffer
+        self._pending = None
+
+    def start(self, buffer):
+        self.finish(buffer)
+        world_size, rank = dist.get_world_size(), dist.get_rank()
+        n = int(self.frac * len(buffer))
+        if world_size == 1 or n == 0:
+            return
+        inds = t.randperm(len(buffer), device=buffer.device)[:n]
+        tensors = [buffer.read(inds)]
+        if self.momentum_buffer is not None:
+            tensors.append(self.momentum_buffer[inds.to(self.momentum_buffer.device)])
+        if buffer.n_classes is not None:
+            tensors.append(buffer.labels[inds])
+        reqs, sent, received = [], [], []
+        for x in tensors:
+            x = x.detach().contiguous().to(_comm_device())
+            x_recv = t.empty_like(x)
+            reqs.append(dist.isend(x, (rank + 1) % world_size))
+            reqs.append(dist.irecv(x_recv, (rank - 1) % world_size))
+            sent.append(x)
+            received.append(x_recv)
+        # the send buffers have to stay alive until the requests complete
+        self._pending = (inds, sent, received, reqs)
+
+    def finish(self, buffer):
+        if self._pending is None:
+            return
+        inds, _, received, reqs = self._pending
+        self._pending = None
+        for req in reqs:
+            req.wait()
+        buffer.write(inds, received.pop(0))
+        if self.momentum_buffer is not None:
+            self.momentum_buffer[inds.to(self.momentum_buffer.device)] = received.pop(0).to(self.momentum_buffer.device)
+        if buffer.n_classes is not None:
+            labels = buffer.labels.clone()
+            labels[inds] = received.pop(0).to(labels.device)
+            buffer.relabel(labels)
@@ -15,13 +15,16 @@
 
 import utils
 import torch as t, torch.nn as nn
-from torch.utils.data import DataLoader, Dataset
+from torch.utils.data import Dataset
 import torchvision as tv, torchvision.transforms as tr
 import os
 import sys
 import argparse
 import numpy as np
 import wideresnet
+import sgld
+from replay_buffer import load_buffer_state
+from data_registry import make_loader
 import pdb
 
 from tqdm import tqdm
@@ -108,18 +111,14 @@ def sample_q(args, device, f, replay_buffer, y=None):
     """this func takes in replay_buffer now so we have the option to sample from
     scratch (i.e. replay_buffer==[]).  See test_wrn_ebm.py for example.
     """
-    f.eval()
     # get batch size
     bs = args.batch_size if y is None else y.size(0)
     # generate initial samples and buffer inds of those samples (if buffer is used)
     init_sample, buffer_inds = sample_p_0(device, replay_buffer, bs=bs, y=y)
-    x_k = t.autograd.Variable(init_sample, requires_grad=True)
     # sgld
-    for k in range(args.n_steps):
-        f_prime = t.autograd.grad(f(x_k, y=y).sum(), [x_k], retain_graph=True)[0]
-        x_k.data += args.sgld_lr * f_prime + args.sgld_std * t.randn_like(x_k)
-    f.train()
-    final_samples = x_k.detach()
+    with sgld.sampling_mode(f):
+        final_samples = sgld.sgld_chain(lambda x: f(x, y=y), init_sample, args.n_steps, args.sgld_lr, args.sgld_std,
+                                        update_fn=sgld.get_sgld_update(args.compile_sgld))
     # update replay buffer
     if len(replay_buffer) > 0:
         replay_buffer[buffer_inds] = final_samples.cpu()
@@ -172,13 +171,7 @@ def logp_hist(f, args, device):
     sns.set()
     plt.switch_backend('agg')
     def sample(x, n_steps=args.n_steps):
-        x_k = t.autograd.Variable(x.clone(), requires_grad=True)
-        # sgld
-        for k in range(n_steps):
-            f_prime = t.autograd.grad(f(x_k).sum(), [x_k], retain_graph=True)[0]
-            x_k.data += f_prime + 1e-2 * t.randn_like(x_k)
-        final_samples = x_k.detach()
-        return final_samples
+        return sgld.sgld_chain(f, x, n_steps, 1., 1e-2, update_fn=sgld.get_sgld_update(args.compile_sgld))
     def grad_norm(x):
         x_k = t.autograd.Variable(x, requires_grad=True)
         f_prime = t.autograd.grad(f(x_k).sum(), [x_k], retain_graph=True)[0]
@@ -229,7 +222,7 @@ def logp_hist(f, args, device):
     for dataset_name in args.datasets:
         print(dataset_name)
         dataset = datasets[dataset_name]
-        dataloader = DataLoader(dataset, batch_size=100, shuffle=True, num_workers=4, drop_last=False)
+        dataloader = make_loader(dataset, batch_size=100, shuffle=True, drop_last=False, num_workers=args.num_workers, prefetch_factor=args.prefetch_factor)
         this_scores = []
         for x, _ in dataloader:
             x = x.to(device)
@@ -260,7 +253,7 @@ def OODAUC(f, args, device):
     )
 
     dset_real = tv.datasets.CIFAR10(root="../data", transform=transform_test, download=True, train=False)
-    dload_real = DataLoader(dset_real, batch_size=100, shuffle=False, num_workers=4, drop_last=False)
+    dload_real = make_loader(dset_real, batch_size=100, shuffle=False, drop_last=False, num_workers=args.num_workers, prefetch_factor=args.prefetch_factor)
 
     if args.ood_dataset == "svhn":
         dset_fake = tv.datasets.SVHN(root="../data", transform=transform_test, download=True, split="test")
@@ -275,7 +268,7 @@ def OODAUC(f, args, device):
     else:
         dset_fake = tv.datasets.CIFAR10(root="../data", transform=transform_test, download=True, train=False)
 
-    dload_fake = DataLoader(dset_fake, batch_size=100, shuffle=True, num_workers=4, drop_last=False)
+    dload_fake = make_loader(dset_fake, batch_size=100, shuffle=True, drop_last=False, num_workers=args.num_workers, prefetch_factor=args.prefetch_factor)
     print(len(dload_real), len(dload_fake))
     real_scores = []
     print("Real scores...")
@@ -330,13 +323,7 @@ def test_clf(f, args, device):
     )
 
     def sample(x, n_steps=args.n_steps):
-        x_k = t.autograd.Variable(x.clone(), requires_grad=True)
-        # sgld
-        for k in range(n_steps):
-            f_prime = t.autograd.grad(f(x_k).sum(), [x_k], retain_graph=True)[0]
-            x_k.data += f_prime + 1e-2 * t.randn_like(x_k)
-        final_samples = x_k.detach()
-        return final_samples
+        return sgld.sgld_chain(f, x, n_steps, 1., 1e-2, update_fn=sgld.get_sgld_update(args.compile_sgld))
 
     if args.dataset == "cifar_train":
         dset = tv.datasets.CIFAR10(root="../data", transform=transform_test, download=True, train=True)
@@ -347,7 +334,7 @@ def test_clf(f, args, device):
     else:  # args.dataset == "svhn_test":
         dset = tv.datasets.SVHN(root="../data", transform=transform_test, download=True, split="test")
 
-    dload = DataLoader(dset, batch_size=100, shuffle=False, num_workers=4, drop_last=False)
+    dload = make_loader(dset, batch_size=100, shuffle=False, drop_last=False, num_workers=args.num_workers, prefetch_factor=args.prefetch_factor)
 
     corrects, losses, pys, preds = [], [], [], []
     for x_p_d, y_p_d in tqdm(dload):
@@ -380,14 +367,22 @@ def main(args):
 
     device = t.device('cuda' if t.cuda.is_available() else 'cpu')
 
-    model_cls = F if args.uncond else CCF
-    f = model_cls(args.depth, args.width, args.norm)
-    print(f"loading model from {args.load_path}")
+    if args.scripted:
+        # a model exported with export_model.py (or train_nn_ebm.py --export_model); it has no replay buffer
+        assert args.eval != "cond_samples" or args.fresh_samples, "use --fresh_samples with an exported model"
+        print(f"loading exported model from {args.load_path}")
+        f = t.jit.load(args.load_path, map_location=device)
+        replay_buffer = []
+    else:
+        model_cls = F if args.uncond else CCF
+        f = model_cls(args.depth, args.width, args.norm)
+        print(f"loading model from {args.load_path}")
 
-    # load em up
-    ckpt_dict = t.load(args.load_path)
-    f.load_state_dict(ckpt_dict["model_state_dict"])
-    replay_buffer = ckpt_dict["replay_buffer"]
+        # load em up
+        ckpt_dict = t.load(args.load_path)
+        f.load_state_dict(ckpt_dict["model_state_dict"])
+        sgld.invalidate_layers(f)
+        replay_buffer = load_buffer_state(ckpt_dict["replay_buffer"])
 
     f = f.to(device)
 
@@ -410,6 +405,8 @@ def main(args):
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser("Energy Based Models and Shit")
+    parser.add_argument("--num_workers", type=int, default=4, help="DataLoader worker processes (kept alive across epochs)")
+    parser.add_argument("--prefetch_factor", type=int, default=2, help="Batches each DataLoader worker loads ahead")
     parser.add_argument("--eval", default="OOD", type=str,
                         choices=["uncond_samples", "cond_samples", "logp_hist", "OOD", "test_clf"])
     parser.add_argument("--score_fn", default="px", type=str,
@@ -437,11 +434,14 @@ if __name__ == "__main__":
     parser.add_argument("--reinit_freq", type=float, default=.05)
     parser.add_argument("--sgld_lr", type=float, default=1.0)
     parser.add_argument("--sgld_std", type=float, default=1e-2)
+    parser.add_argument("--compile_sgld", action="store_true", help="Fuse the SGLD update with torch.compile (or TorchScript)")
     # logging + evaluation
     parser.add_argument("--save_dir", type=str, default='YOUR_SAVE_PATH_BUDDDDDDYYYYYYY')
     parser.add_argument("--print_every", type=int, default=100)
     parser.add_argument("--n_sample_steps", type=int, default=100)
     parser.add_argument("--load_path", type=str, default=None)
+    parser.add_argument("--scripted", action="store_true",
+                        help="load_path is a standalone TorchScript model from export_model.py")
     parser.add_argument("--print_to_log", action="store_true")
     parser.add_argument("--fresh_samples", action="store_true",
                         help="If set, then we generate a new replay buffer from scratch for conditional sampling,"
@@ -0,0 +1,75 @@
+import argparse
+from typing import Optional
+import torch as t, torch.nn as nn
+import wideresnet
+
+
+class ScriptedEBM(nn.Module):
+    """Scriptable stand-in for the F/CCF classes of the training and eval scripts: backbone f
+    with the energy and class heads. Submodule names match theirs, so their state dicts load
+    into it, and forward(x, y=None) / classify(x) behave the same way.
+    """
+
+    def __init__(self, f, energy_output, class_output, conditional=True):
+        super(ScriptedEBM, self).__init__()
+        self.f = f
+        self.energy_output = energy_output
+        self.class_output = class_output
+        self.conditional = conditional
+
+    def forward(self, x, y: Optional[t.Tensor] = None):
+        if self.conditional:
+            logits = self.classify(x)
+            if y is None:
+                return logits.logsumexp(1)
+            return t.gather(logits, 1, y[:, None])
+        return self.energy_output(self.f(x)).squeeze()
+
+    @t.jit.export
+    def classify(self, x):
+        # squeezed like the training scripts' F.classify, so shapes match the eager model
+        return self.class_output(self.f(x)).squeeze()
+
+
+def export_model(f, example_x, conditional=True, path=None):
+    """Turns a trained F/CCF (anything with .f, .energy_output and .class_output) into a frozen
+    TorchScript module that runs without this repo's classes or the training args: the backbone
+    is traced on example_x in eval mode (norms use their running statistics) and the heads are
+    scripted around it. Input gradients still work, so it serves for classification and SGLD
+    sampling alike. Saved to path if given; load it back with torch.jit.load.
+    """
+    training = f.training
+    f.eval()
+    try:
+        with t.no_grad():
+            backbone = t.jit.trace(f.f, example_x)
+        scripted = t.jit.script(ScriptedEBM(backbone, f.energy_output, f.class_output, conditional))
+        frozen = t.jit.freeze(scripted.eval(), preserved_attrs=["classify"])
+    finally:
+        f.train(training)
+    if path is not None:
+        frozen.save(path)
+    return frozen
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser("Export a Wide_ResNet JEM checkpoint as a standalone TorchScript model")
+    parser.add_argument("--load_path", type=str, required=True, help="Checkpoint with a model_state_dict")
+    parser.add_argument("--save_path", type=str, required=True)
+    parser.add_argument("--depth", type=int, default=28)
+    parser.add_argument("--width", type=int, default=10)
+    parser.add_argument("--norm", type=str, default=None, choices=[None, "norm", "batch", "instance", "layer", "act"])
+    parser.add_argument("--n_classes", type=int, default=10)
+    parser.add_argument("--n_ch", type=int, default=3)
+    parser.add_argument("--im_sz", type=int, default=32)
+    parser.add_argument("--uncond", action="store_true", help="Export an F (energy head) instead of a CCF")
+    args = parser.parse_args()
+
+    backbone = wideresnet.Wide_ResNet(args.depth, args.width, norm=args.norm, input_channels=args.n_ch)
+    f = ScriptedEBM(backbone, nn.Linear(backbone.last_dim, 1), nn.Linear(backbone.last_dim, args.n_classes),
+                    conditional=not args.uncond)
+    ckpt_dict = t.load(args.load_path, map_location="cpu")
+    f.load_state_dict(ckpt_dict["model_state_dict"] if "model_state_dict" in ckpt_dict else ckpt_dict)
+    export_model(f, t.zeros(2, args.n_ch, args.im_sz, args.im_sz), conditional=not args.uncond,
+                 path=args.save_path)
+    print("exported {} to {}".format(args.load_path, args.save_path))
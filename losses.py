@@ -36,9 +36,8 @@ class VATLoss(nn.Module):
             pred_hat = model.classify(x + self.xi * d)
             logp_hat = t.nn.functional.log_softmax(pred_hat, dim=1)
             adv_distance = t.nn.functional.kl_div(logp_hat, pred, reduction='batchmean')
-            adv_distance.backward()
-            d = _l2_normalize(d.grad)
-            model.zero_grad()
+            # only the direction's gradient, so gradients accumulated in the model are left alone
+            d = _l2_normalize(t.autograd.grad(adv_distance, [d])[0])
 
         # calc LDS
         r_adv = d * self.eps
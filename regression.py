@@ -9,8 +9,8 @@ import torch.distributions as distributions
 import torch.utils
 import torch.utils.data
 import hmc
-import pandas as pd
 import utils
+import regression_datasets
 device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
 print("Device is {}".format(device))
 stepsize = 1.
@@ -115,32 +115,36 @@ class EBM(nn.Module):
         ypb = self.predict_fn(x[None], ymin, ymax)[0]
         plt.plot([ypb.item(), ypb.item()], [0., max(p_y_given_x)], c='g')
 
+def get_streaming_data(args):
+    """get_data for tables too large to load: chunked loaders over the memory-mapped cache,
+    with normalization stats from a single pass (no feature histograms are plotted).
+    """
+    train, test, args.data_dim = regression_datasets.get_streaming_data(args.dataset, test_frac=args.test_frac,
+                                                                        seed=args.seed, n_classes=None)
+    if args.n_labels != -1:
+        train = train.subset(np.sort(np.random.RandomState(args.seed).permutation(train.rows)[:args.n_labels]))
+    yind = train.y_col
+    mu, std = train.mu, train.std
+    mu_t, std_t = torch.from_numpy(mu[None]).float()[0], torch.from_numpy(std[None]).float()[0]
+    init_dist = distributions.Normal(torch.zeros_like(mu_t), torch.ones_like(std_t))
+    unnormalize = lambda y: y * std[yind] + mu[yind]
+    ytr = train.target_values()
+    ymin, ymax = ytr.min(), ytr.max()
+    print(len(train), len(test))
+    print(ymin, ymax)
+
+    dload_train = regression_datasets.TabularLoader(train, args.batch_size, shuffle=True, drop_last=True)
+    dload_test = regression_datasets.TabularLoader(test, args.batch_size, shuffle=False, drop_last=False)
+    return dload_train, dload_test, init_dist, unnormalize, yind, ymin, ymax
+
+
 def get_data(args):
-    if args.dataset == "concrete":
-        training_data_x = pd.read_excel("data/concrete.xls")
-        args.data_dim = 8
-        x = training_data_x.to_numpy()
-    elif args.dataset == "protein":
-        training_data_x = pd.read_csv("data/protein.csv")
-        args.data_dim = 9
-        x = training_data_x.to_numpy()
-    elif args.dataset == "power_plant":
-        training_data_x = pd.read_excel("data/power_plant/Folds5x2_pp.xlsx")
-        args.data_dim = 4
-        x = training_data_x.to_numpy()
-    elif args.dataset == "navy":
-        with open("data/navy.txt", 'r') as f:
-            lines = f.readlines()
-            vals = []
-            for line in lines:
-                ls = line.split()
-                ls = [float(v) for v in ls]
-                vals.append(ls)
-        x = np.array(vals).astype(np.float)
-        x = x[:, :-1]  # take out last thing
-        args.data_dim = 16
-    else:
+    if args.stream or args.dataset == "year":
+        return get_streaming_data(args)
+    if args.dataset not in ("concrete", "protein", "power_plant", "navy"):
         raise ValueError
+    x = regression_datasets.load_raw(args.dataset)
+    args.data_dim = regression_datasets.DATA_DIMS[args.dataset]
 
 
     print(x.shape)
@@ -529,6 +533,8 @@ if __name__ == "__main__":
     # optimization
     parser.add_argument("--lr", type=float, default=1e-3)
     parser.add_argument("--test_frac", type=float, default=.1)
+    parser.add_argument("--stream", action="store_true",
+                        help="Read the dataset in shuffled chunks from its memory-mapped cache (always on for year)")
     parser.add_argument("--v_norm", type=float, default=.01)
     parser.add_argument("--decay_epochs", nargs="+", type=int, default=[160, 180],
                         help="decay learning rate by decay_rate at these epochs")
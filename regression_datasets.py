@@ -2,49 +2,84 @@ import torch
 import pandas as pd
 import numpy as np
 import pickle
+import hashlib
+import json
+import os
+import tempfile
 
 
-def get_data(dataset, test_frac=.1, seed=1234, n_classes=10):
-    if dataset == "concrete":
-        training_data_x = pd.read_excel("data/concrete.xls")
-        data_dim = 8
-        x = training_data_x.to_numpy()
+SOURCES = {
+    "concrete": "data/concrete.xls",
+    "protein": "data/protein.csv",
+    "power_plant": "data/power_plant/Folds5x2_pp.xlsx",
+    "navy": "data/navy.txt",
+    "year": "data/year.pkl",
+}
+DATA_DIMS = {"concrete": 8, "protein": 9, "power_plant": 4, "navy": 16, "year": 90}
+
+
+def parse_raw(dataset):
+    path = SOURCES[dataset]
+    if dataset == "concrete" or dataset == "power_plant":
+        x = pd.read_excel(path).to_numpy()
     elif dataset == "protein":
-        training_data_x = pd.read_csv("data/protein.csv")
-        data_dim = 9
-        x = training_data_x.to_numpy()
-    elif dataset == "power_plant":
-        training_data_x = pd.read_excel("data/power_plant/Folds5x2_pp.xlsx")
-        data_dim = 4
-        x = training_data_x.to_numpy()
+        x = pd.read_csv(path).to_numpy()
     elif dataset == "navy":
-        with open("data/navy.txt", 'r') as f:
-            lines = f.readlines()
-            vals = []
-            for line in lines:
-                ls = line.split()
-                ls = [float(v) for v in ls]
-                vals.append(ls)
-        x = np.array(vals).astype(np.float)
+        x = np.loadtxt(path, dtype=np.float64)
         x = x[:, :-1]  # take out last thing
-        data_dim = 16
     elif dataset == "year":
-        # with open("data/year.txt", 'r') as f:
-        #     lines = f.readlines()
-        #     vals = []
-        #     for line in lines:
-        #         ls = line.strip().split(',')
-        #         ls = [float(v) for v in ls]
-        #         vals.append(ls)
-        # x = np.array(vals).astype(np.float)
-        with open("data/year.pkl", 'rb') as f:
+        with open(path, 'rb') as f:
             x = pickle.load(f)
-        #import pickle
-        #pickle.dump(x, open("data/year.pkl", 'wb'))
-        #1/0
-        data_dim = 90
     else:
         raise ValueError
+    return np.ascontiguousarray(x, dtype=np.float64)
+
+
+def file_hash(path):
+    h = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            h.update(block)
+    return h.hexdigest()
+
+
+def load_raw(dataset, cache_dir="data/cache"):
+    """The raw [n, d] float64 array of a regression dataset, memory-mapped from a .npy cache.
+
+    The first run parses the source file and writes cache_dir/<dataset>-<sha1 of source>.npy;
+    later runs open it directly. The source is only rehashed when its size or mtime changes.
+    """
+    if dataset not in SOURCES:
+        raise ValueError
+    path = SOURCES[dataset]
+    stat = os.stat(path)
+    meta_path = os.path.join(cache_dir, dataset + ".json")
+    meta = {}
+    if os.path.exists(meta_path):
+        with open(meta_path) as f:
+            meta = json.load(f)
+    stale = meta.get("size") != stat.st_size or meta.get("mtime") != stat.st_mtime
+    if stale:
+        meta = {"size": stat.st_size, "mtime": stat.st_mtime, "sha1": file_hash(path)}
+    cache_path = os.path.join(cache_dir, "{}-{}.npy".format(dataset, meta["sha1"]))
+    if not os.path.exists(cache_path):
+        os.makedirs(cache_dir, exist_ok=True)
+        # unique temporary names: several processes (e.g. distributed ranks) may fill the cache at once
+        fd, tmp_path = tempfile.mkstemp(dir=cache_dir, suffix=".tmp.npy")
+        with os.fdopen(fd, "wb") as f:
+            np.save(f, parse_raw(dataset))
+        os.replace(tmp_path, cache_path)
+    if stale:
+        fd, tmp_path = tempfile.mkstemp(dir=cache_dir, suffix=".tmp.json")
+        with os.fdopen(fd, "w") as f:
+            json.dump(meta, f)
+        os.replace(tmp_path, meta_path)
+    return np.load(cache_path, mmap_mode='r')
+
+
+def get_data(dataset, test_frac=.1, seed=1234, n_classes=10):
+    x = load_raw(dataset)
+    data_dim = DATA_DIMS[dataset]
 
     mu = x.mean(0)
     std = x.std(0)
@@ -76,7 +111,7 @@ def get_data(dataset, test_frac=.1, seed=1234, n_classes=10):
         raise ValueError
 
     # compute bins
-    y_sorted = sorted(ytr)
+    y_sorted = np.sort(ytr)
 
     n_per_class = len(y_sorted) // n_classes
     buckets = []
@@ -85,14 +120,10 @@ def get_data(dataset, test_frac=.1, seed=1234, n_classes=10):
         b = y_sorted[ind]
         buckets.append(b)
 
-    def reg_to_clf(y):
-        for i in range(n_classes - 1):
-            if y < buckets[i]:
-                return i
-        return n_classes - 1
-
-    ytr_clf = np.array([reg_to_clf(y) for y in ytr])
-    yte_clf = np.array([reg_to_clf(y) for y in yte])
+    # class i is the first bucket boundary above y, i.e. the number of boundaries <= y
+    buckets = np.array(buckets)
+    ytr_clf = np.searchsorted(buckets, ytr, side='right')
+    yte_clf = np.searchsorted(buckets, yte, side='right')
     # import matplotlib.pyplot as plt
     # plt.hist(ytr_clf)
     # plt.hist(yte_clf)
@@ -106,6 +137,155 @@ def get_data(dataset, test_frac=.1, seed=1234, n_classes=10):
     return dset_train, dset_test, data_dim
 
 
+def welford_stats(x, chunk_rows=65536):
+    """Per-column mean and (population) std of x in one pass over chunks of rows, merging the
+    chunk statistics with Welford's/Chan's update so x never has to be in memory at once.
+    """
+    n, mean, m2 = 0, np.zeros(x.shape[1]), np.zeros(x.shape[1])
+    for start in range(0, x.shape[0], chunk_rows):
+        chunk = np.asarray(x[start:start + chunk_rows], dtype=np.float64)
+        n_b, mean_b = chunk.shape[0], chunk.mean(0)
+        m2_b = ((chunk - mean_b) ** 2).sum(0)
+        delta = mean_b - mean
+        mean = mean + delta * n_b / (n + n_b)
+        m2 = m2 + m2_b + delta ** 2 * n * n_b / (n + n_b)
+        n += n_b
+    return mean, np.sqrt(m2 / n)
+
+
+class TabularStream(object):
+    """Rows of a memory-mapped [n, d] table (inputs plus one target column y_col), normalized
+    with per-column stats on the fly. rows selects the rows belonging to this split.
+
+    With buckets the target is the class of the normalized y (as in get_data), otherwise the
+    normalized y itself. Indexing reads only the requested rows; iterate with TabularLoader.
+    """
+
+    def __init__(self, x, y_col, rows, mu, std, buckets=None, block_size=4096):
+        self.x = x
+        self.y_col = y_col % x.shape[1]
+        self.rows = rows
+        self.mu, self.std = mu, std
+        self.buckets = buckets
+        self.block_size = block_size
+        self.x_cols = np.array([c for c in range(x.shape[1]) if c != self.y_col])
+        self._targets = None
+
+    def __len__(self):
+        return len(self.rows)
+
+    def subset(self, rows):
+        return TabularStream(self.x, self.y_col, rows, self.mu, self.std, buckets=self.buckets,
+                             block_size=self.block_size)
+
+    def read_rows(self, rows):
+        """Normalized (x, y) tensors for absolute row numbers of the table."""
+        order = np.argsort(rows)
+        raw = np.empty((len(rows), self.x.shape[1]))
+        raw[order] = self.x[np.asarray(rows)[order]] # sorted reads are sequential on disk
+        raw = (raw - self.mu[None]) / (self.std[None] + 1e-6)
+        x, y = raw[:, self.x_cols], raw[:, self.y_col]
+        if self.buckets is not None:
+            return torch.from_numpy(x).float(), torch.from_numpy(np.searchsorted(self.buckets, y, side='right')).long()
+        return torch.from_numpy(x).float(), torch.from_numpy(y).float()
+
+    def __getitem__(self, index):
+        if isinstance(index, (int, np.integer)):
+            x, y = self.read_rows(self.rows[[index]])
+            return x[0], y[0]
+        return self.read_rows(self.rows[index])
+
+    def target_values(self):
+        """Normalized y of every row, read as a single column."""
+        return (self.x[self.rows, self.y_col] - self.mu[self.y_col]) / (self.std[self.y_col] + 1e-6)
+
+    @property
+    def targets(self):
+        if self._targets is None:
+            self._targets = np.searchsorted(self.buckets, self.target_values(), side='right')
+        return self._targets
+
+
+class TabularLoader(object):
+    """Minibatches of a TabularStream read chunk by chunk. Each epoch permutes blocks of
+    block_size consecutive rows, reads chunk_blocks blocks at a time and shuffles rows within
+    the chunk, so memory stays at one chunk and disk reads stay mostly sequential.
+    exclude drops rows (positions in the stream, e.g. a validation split) from the batches.
+    """
+
+    def __init__(self, stream, batch_size, shuffle=True, drop_last=True, exclude=None, chunk_blocks=16):
+        self.stream = stream
+        self.batch_size = batch_size
+        self.shuffle = shuffle
+        self.drop_last = drop_last
+        self.chunk_blocks = chunk_blocks
+        keep = np.ones(len(stream), dtype=bool)
+        if exclude is not None:
+            keep[np.asarray(exclude, dtype=np.int64)] = False
+        self.positions = np.nonzero(keep)[0]
+
+    def __len__(self):
+        if self.drop_last:
+            return len(self.positions) // self.batch_size
+        return (len(self.positions) + self.batch_size - 1) // self.batch_size
+
+    def __iter__(self):
+        block_size = self.stream.block_size
+        blocks = [self.positions[i:i + block_size] for i in range(0, len(self.positions), block_size)]
+        if self.shuffle:
+            blocks = [blocks[b] for b in np.random.permutation(len(blocks))]
+        carry_x = carry_y = None
+        for c in range(0, len(blocks), self.chunk_blocks):
+            positions = np.concatenate(blocks[c:c + self.chunk_blocks])
+            if self.shuffle:
+                positions = np.random.permutation(positions)
+            x, y = self.stream[positions]
+            if carry_x is not None:
+                x, y = torch.cat([carry_x, x]), torch.cat([carry_y, y])
+            n_full = x.size(0) // self.batch_size * self.batch_size
+            for i in range(0, n_full, self.batch_size):
+                yield x[i:i + self.batch_size], y[i:i + self.batch_size]
+            carry_x, carry_y = x[n_full:], y[n_full:]
+        if carry_x is not None and carry_x.size(0) > 0 and not self.drop_last:
+            yield carry_x, carry_y
+
+
+def get_streaming_data(dataset, test_frac=.1, seed=1234, n_classes=10, block_size=4096):
+    """Like get_data, but returns TabularStreams over the memory-mapped table instead of
+    in-memory TensorDatasets. The train/test split is drawn at the level of blocks of
+    block_size rows, so both splits stay mostly contiguous on disk. n_classes=None keeps the
+    normalized regression target instead of bucketing it.
+    """
+    x = load_raw(dataset)
+    data_dim = DATA_DIMS[dataset]
+    mu, std = welford_stats(x)
+
+    n = x.shape[0]
+    n_test = int(n * test_frac)
+    if dataset == "year":
+        n_test = 51630
+    n_blocks = (n + block_size - 1) // block_size
+    block_perm = np.random.RandomState(seed).permutation(n_blocks)
+    n_test_blocks = max(1, int(round(n_test / block_size)))
+    is_test = np.zeros(n, dtype=bool)
+    for b in block_perm[:n_test_blocks]:
+        is_test[b * block_size:(b + 1) * block_size] = True
+    train_rows, test_rows = np.nonzero(~is_test)[0], np.nonzero(is_test)[0]
+
+    # protein is [y, x], the others [x, y]
+    y_col = 0 if dataset == "protein" else -1
+    train = TabularStream(x, y_col, train_rows, mu, std, block_size=block_size)
+    buckets = None
+    if n_classes is not None:
+        # compute bins
+        y_sorted = np.sort(train.target_values())
+        n_per_class = len(y_sorted) // n_classes
+        buckets = y_sorted[[(i + 1) * n_per_class for i in range(n_classes - 1)]]
+    train = TabularStream(x, y_col, train_rows, mu, std, buckets=buckets, block_size=block_size)
+    test = TabularStream(x, y_col, test_rows, mu, std, buckets=buckets, block_size=block_size)
+    return train, test, data_dim
+
+
 if __name__ == "__main__":
     tr, te, ddim = get_data("year")
     print(ddim, tr[0][0].size())
@@ -0,0 +1,488 @@
+import json
+import math
+import os
+import numpy as np
+import torch as t
+
+
+class ReplayBuffer(object):
+    """PCD replay buffer of persistent SGLD chains.
+
+    The storage lives on `device` (the training device by default), so drawing chain
+    initializations and writing finished chains back never round-trip through the host.
+
+    Each row belongs to one class. Rows are kept grouped by class in class_order, with
+    class_start/class_count giving each class's slice, so class sizes can be uneven and can
+    change (relabel) while class-conditional draws stay O(1) per row. Initially the classes
+    are contiguous blocks of (nearly) equal size.
+    """
+
+    def __init__(self, buffer, init_fn, reinit_freq=.05, n_classes=None, device=None):
+        self.device = buffer.device if device is None else t.device(device)
+        self.buffer = buffer.to(self.device)
+        # init_fn(bs, device) draws bs fresh chain initializations
+        self.init_fn = init_fn
+        self.reinit_freq = reinit_freq
+        self.n_classes = n_classes
+        self._init_class_index()
+
+    def __len__(self):
+        return self.buffer.size(0)
+
+    def _init_class_index(self):
+        if self.n_classes is not None:
+            self.relabel(t.arange(len(self), device=self.device) * self.n_classes // len(self))
+
+    def relabel(self, labels):
+        """Reassigns row i to class labels[i] and rebuilds the per-class index."""
+        self.labels = labels.to(self.device).long()
+        self.class_order = t.argsort(self.labels)
+        self.class_count = t.bincount(self.labels, minlength=self.n_classes)
+        self.class_start = t.cumsum(self.class_count, 0) - self.class_count
+
+    def sample_inds(self, bs, y=None):
+        uniform_inds = t.randint(0, len(self), (bs,), device=self.device)
+        if y is None:
+            return uniform_inds
+        # if cond, draw uniformly within each row's class; classes without rows fall back to any row
+        y = y.to(self.device)
+        count = self.class_count[y]
+        pos = self.class_start[y] + (t.rand(bs, device=self.device) * count).long()
+        inds = self.class_order[pos.clamp(max=len(self) - 1)]
+        return t.where(count > 0, inds, uniform_inds)
+
+    def read(self, inds):
+        return self.buffer[inds]
+
+    def write(self, inds, samples):
+        with t.no_grad():
+            self.buffer.index_copy_(0, inds, samples.to(self.device, self.buffer.dtype))
+
+    def sample(self, bs, y=None, data=None):
+        """Returns (initial samples, buffer inds, positions within the batch that were reinitialized).
+        Reinitialized rows come from data if given, otherwise from init_fn; fresh rows are only
+        generated for those positions.
+        """
+        inds = self.sample_inds(bs, y)
+        samples = self.read(inds)
+        reinit_inds = self.reinit(samples, data)
+        return samples, inds, reinit_inds
+
+    def reinit(self, samples, data=None):
+        """Reinitializes a reinit_freq fraction of the rows of samples in place, on samples' device."""
+        device = samples.device
+        reinit_inds = (t.rand(samples.size(0), device=device) < self.reinit_freq).nonzero().squeeze(1)
+        if data is not None:
+            fresh = data.to(device).index_select(0, reinit_inds)
+        else:
+            fresh = self.init_fn(reinit_inds.size(0), device)
+        samples.index_copy_(0, reinit_inds, fresh.to(samples.dtype))
+        return reinit_inds
+
+    def checkpoint_state(self):
+        return self.buffer.detach().cpu()
+
+
+class PinnedReplayBuffer(ReplayBuffer):
+    """Replay buffer kept in page-locked host memory, for buffers too large for the device.
+
+    Right after a chain is initialized, the rows for the next unconditional draw of the same
+    size are gathered and copied to `device` on a side stream, overlapping with the chain.
+    Finished chains are copied back with non-blocking copies and scattered into the host
+    buffer once the copy has landed (at the latest on the next access). Prefetched rows that
+    a write-back overwrites are patched on the device, so chains never restart from stale rows.
+    Without CUDA this degrades to a plain host buffer.
+    """
+
+    def __init__(self, buffer, init_fn, reinit_freq=.05, n_classes=None, device=None):
+        super(PinnedReplayBuffer, self).__init__(buffer, init_fn, reinit_freq=reinit_freq,
+                                                 n_classes=n_classes, device="cpu")
+        self.target = t.device("cpu") if device is None else t.device(device)
+        if self.target.type == "cuda":
+            self.buffer = self.buffer.pin_memory()
+            self.stream = t.cuda.Stream(self.target)
+        else:
+            self.stream = None
+        self._next = None  # (inds, rows on target) prefetched for the next unconditional draw
+        self._pending = None  # (inds, pinned staging rows, event) of the last write-back
+
+    def _flush(self):
+        if self._pending is not None:
+            inds, staging, event = self._pending
+            event.synchronize()
+            with t.no_grad():
+                self.buffer.index_copy_(0, inds, staging)
+            self._pending = None
+
+    def _gather(self, inds):
+        rows = self.buffer.index_select(0, inds)
+        if self.stream is None:
+            return rows
+        return rows.pin_memory().to(self.target, non_blocking=True)
+
+    def _prefetch(self, bs):
+        if self.stream is None:
+            return
+        inds = self.sample_inds(bs)
+        with t.cuda.stream(self.stream):
+            rows = self._gather(inds)
+        self._next = (inds, rows)
+
+    def read(self, inds):
+        self._flush()
+        return self.buffer[inds.cpu()]
+
+    def sample(self, bs, y=None, data=None):
+        self._flush()
+        if y is None and self._next is not None and self._next[0].size(0) == bs:
+            inds, samples = self._next
+            self._next = None
+            current = t.cuda.current_stream(self.target)
+            current.wait_stream(self.stream)
+            samples.record_stream(current)
+        else:
+            inds = self.sample_inds(bs, y)
+            samples = self._gather(inds)
+        if y is None:
+            self._prefetch(bs)
+        reinit_inds = self.reinit(samples, data)
+        return samples, inds, reinit_inds
+
+    def write(self, inds, samples):
+        self._flush()
+        inds = inds.cpu()
+        samples = samples.detach()
+        if self._next is not None:
+            next_inds, next_rows = self._next
+            match = next_inds[:, None] == inds[None, :]
+            hit = match.any(1)
+            if hit.any():
+                current = t.cuda.current_stream(self.target)
+                current.wait_stream(self.stream)
+                next_rows.record_stream(current)
+                src = match.int().argmax(1)
+                next_rows[hit.to(self.target)] = samples[src[hit].to(self.target)].to(next_rows.dtype)
+        if self.stream is None or samples.device.type != "cuda":
+            super(PinnedReplayBuffer, self).write(inds, samples)
+            return
+        staging = t.empty(samples.shape, dtype=self.buffer.dtype, pin_memory=True)
+        staging.copy_(samples, non_blocking=True)
+        event = t.cuda.Event()
+        event.record()
+        self._pending = (inds, staging, event)
+
+    def checkpoint_state(self):
+        self._flush()
+        return super(PinnedReplayBuffer, self).checkpoint_state()
+
+
+class QuantizedReplayBuffer(ReplayBuffer):
+    """Replay buffer storing chains compactly: "float16" (2x smaller), or "uint8" with a
+    per-sample affine scale/offset (4x smaller). Rows are dequantized to float32 on read and
+    quantized on write, so callers see the same interface as ReplayBuffer.
+    """
+
+    def __init__(self, buffer, init_fn, reinit_freq=.05, n_classes=None, device=None, storage="uint8"):
+        assert storage in ("float16", "uint8"), "Unknown replay buffer storage {}".format(storage)
+        self.device = buffer.device if device is None else t.device(device)
+        self.init_fn = init_fn
+        self.reinit_freq = reinit_freq
+        self.n_classes = n_classes
+        self.storage = storage
+        n = buffer.size(0)
+        if storage == "float16":
+            self.buffer = buffer.to(t.float16).to(self.device)
+        else:
+            self.buffer = t.empty(buffer.shape, dtype=t.uint8, device=self.device)
+            self.scale = t.empty(n, device=self.device)
+            self.offset = t.empty(n, device=self.device)
+            # quantize chunk by chunk so the float buffer never has to sit on the device
+            chunk_size = 10000
+            for i in range(0, n, chunk_size):
+                inds = t.arange(i, min(i + chunk_size, n), device=self.device)
+                self.write(inds, buffer[i:i + chunk_size])
+        self._init_class_index()
+
+    def _quantize(self, samples):
+        flat = samples.reshape(samples.size(0), -1)
+        lo, hi = flat.min(1)[0], flat.max(1)[0]
+        scale = (hi - lo).clamp(min=1e-8) / 255.
+        q = ((flat - lo[:, None]) / scale[:, None]).round_().clamp_(0, 255).to(t.uint8)
+        return q.view(samples.shape), scale, lo
+
+    def read(self, inds):
+        rows = self.buffer[inds].float()
+        if self.storage == "float16":
+            return rows
+        shape = (-1,) + (1,) * (rows.dim() - 1)
+        return rows * self.scale[inds].view(shape) + self.offset[inds].view(shape)
+
+    def write(self, inds, samples):
+        with t.no_grad():
+            samples = samples.detach().to(self.device, t.float32)
+            if self.storage == "float16":
+                self.buffer.index_copy_(0, inds, samples.half())
+            else:
+                q, scale, lo = self._quantize(samples)
+                self.buffer.index_copy_(0, inds, q)
+                self.scale.index_copy_(0, inds, scale)
+                self.offset.index_copy_(0, inds, lo)
+
+    def checkpoint_state(self):
+        # checkpoints keep the float32 format so they load with any backend
+        chunk_size = 10000
+        return t.cat([self.read(t.arange(i, min(i + chunk_size, len(self)), device=self.device)).cpu()
+                      for i in range(0, len(self), chunk_size)])
+
+
+def _read_generation(path):
+    meta_path = path + ".json"
+    if not os.path.exists(meta_path):
+        return 0
+    with open(meta_path) as f:
+        return json.load(f)["generation"]
+
+
+def _undo_dtype(row_shape):
+    return np.dtype([("ind", np.int64), ("row", np.float32, row_shape)])
+
+
+def _undo_records(path, generation, row_shape):
+    """The undo records (buffer index, row as of the checkpoint) logged since checkpoint generation,
+    as a read-only array (empty if the log belongs to another generation). A record torn by a
+    crash is dropped: its row was not overwritten yet.
+    """
+    undo_path = path + ".undo"
+    dtype = _undo_dtype(row_shape)
+    if not os.path.exists(undo_path):
+        return np.empty(0, dtype)
+    with open(undo_path, "rb") as f:
+        header = np.fromfile(f, dtype=np.int64, count=1)
+    n = (os.path.getsize(undo_path) - 8) // dtype.itemsize
+    if header.size == 0 or header[0] != generation or n <= 0:
+        return np.empty(0, dtype)
+    return np.memmap(undo_path, dtype=dtype, mode="r", offset=8, shape=(n,))
+
+
+def _rollback(array, path, generation):
+    """Undoes in array (the buffer at path, or a copy of it) every row write made after checkpoint
+    generation, so it holds exactly the chains that checkpoint was taken with."""
+    records = _undo_records(path, generation, array.shape[1:])
+    chunk_size = 10000
+    for i in range(0, len(records), chunk_size):
+        chunk = records[i:i + chunk_size]
+        array[chunk["ind"]] = chunk["row"]
+
+
+def _check_reference(state):
+    generation = _read_generation(state["memmap"])
+    if generation != state["generation"]:
+        raise ValueError("Replay buffer {} is at generation {}, checkpoint refers to generation {}; only the "
+                         "newest checkpoint of a memmap buffer can be restored".format(
+                             state["memmap"], generation, state["generation"]))
+
+
+def load_buffer_state(state):
+    """Turns the "replay_buffer" entry of a checkpoint back into a tensor. Entries are either the
+    buffer itself or, for memmap-backed buffers, a reference {"memmap": path, "generation": g}.
+    """
+    if not isinstance(state, dict):
+        return state
+    _check_reference(state)
+    buffer = np.array(np.load(state["memmap"], mmap_mode="r"))
+    _rollback(buffer, state["memmap"], state["generation"])
+    return t.from_numpy(buffer)
+
+
+class MemmapReplayBuffer(ReplayBuffer):
+    """Replay buffer stored in a memory-mapped .npy file, so it can grow beyond RAM and
+    checkpoints only need to hold a reference to it.
+
+    The file is written in place. Before a row is first overwritten after a checkpoint, its old
+    contents are appended (and fsynced) to the undo log path + ".undo", so the OS flushing pages
+    of the mapping at any time never loses the checkpointed chains. A checkpoint flushes the
+    mapping, bumps a generation counter in the sidecar path + ".json" (the commit point) and
+    starts a new undo log, which costs O(rows written since the last checkpoint) rather than
+    O(buffer). Loading a reference rolls the file back with the undo log; only the newest
+    generation can be restored, older checkpoints raise.
+    """
+
+    def __init__(self, path, init_fn, reinit_freq=.05, n_classes=None, buffer=None):
+        """buffer is the initial contents (a tensor or a checkpoint reference), or a number of rows
+        to fill from init_fn chunk by chunk; if None, or a reference to path itself, the existing
+        file at path is rolled back to its last checkpoint and reopened in place.
+        """
+        self.path = path
+        if isinstance(buffer, dict) and os.path.abspath(buffer["memmap"]) == os.path.abspath(path):
+            _check_reference(buffer)
+            buffer = None
+        if buffer is None:
+            self.generation = _read_generation(path)
+            self.memmap = np.lib.format.open_memmap(path, mode="r+")
+            _rollback(self.memmap, path, self.generation)
+            # the rolled back rows must be on disk before the undo log is restarted
+            self.memmap.flush()
+        else:
+            # a new file: logs and generations of an earlier buffer at path no longer apply
+            for stale in (path + ".json", path + ".undo"):
+                if os.path.exists(stale):
+                    os.remove(stale)
+            self.generation = 0
+            if isinstance(buffer, int):
+                row_shape = tuple(init_fn(1, "cpu").shape[1:])
+                self.memmap = np.lib.format.open_memmap(path, mode="w+", dtype=np.float32,
+                                                        shape=(buffer,) + row_shape)
+                chunk_size = 10000
+                for i in range(0, buffer, chunk_size):
+                    n = min(chunk_size, buffer - i)
+                    self.memmap[i:i + n] = init_fn(n, "cpu").numpy()
+            else:
+                if isinstance(buffer, dict):
+                    source = buffer
+                    _check_reference(source)
+                    buffer = np.load(source["memmap"], mmap_mode="r")
+                else:
+                    source, buffer = None, buffer.detach().cpu().numpy()
+                self.memmap = np.lib.format.open_memmap(path, mode="w+", dtype=np.float32, shape=buffer.shape)
+                self.memmap[:] = buffer
+                if source is not None:
+                    _rollback(self.memmap, source["memmap"], source["generation"])
+        self._undo_dtype = _undo_dtype(self.memmap.shape[1:])
+        self._dirty = t.zeros(self.memmap.shape[0], dtype=t.bool)
+        self._undo_file = None
+        if self.generation > 0:
+            self._start_undo_log()
+        super(MemmapReplayBuffer, self).__init__(t.from_numpy(self.memmap), init_fn, reinit_freq=reinit_freq,
+                                                 n_classes=n_classes, device="cpu")
+
+    def _start_undo_log(self):
+        if self._undo_file is not None:
+            self._undo_file.close()
+        self._undo_file = open(self.path + ".undo", "wb")
+        self._undo_file.write(np.int64(self.generation).tobytes())
+        self._undo_file.flush()
+        os.fsync(self._undo_file.fileno())
+        self._dirty.zero_()
+
+    def write(self, inds, samples):
+        if self._undo_file is not None:
+            # rows not written since the last checkpoint: log their checkpointed contents first
+            inds_cpu = inds.cpu()
+            new = inds_cpu[~self._dirty[inds_cpu]].unique()
+            if new.numel() > 0:
+                records = np.empty(new.numel(), self._undo_dtype)
+                records["ind"] = new.numpy()
+                records["row"] = self.memmap[new.numpy()]
+                self._undo_file.write(records.tobytes())
+                self._undo_file.flush()
+                os.fsync(self._undo_file.fileno())
+                self._dirty[new] = True
+        super(MemmapReplayBuffer, self).write(inds, samples)
+
+    def checkpoint_state(self):
+        self.memmap.flush()
+        with open(self.path, "rb+") as f:
+            os.fsync(f.fileno())
+        self.generation += 1
+        meta = {"generation": self.generation, "shape": list(self.memmap.shape), "dtype": str(self.memmap.dtype)}
+        tmp_path = self.path + ".json.tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(meta, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, self.path + ".json")
+        # the log of the previous generation is stale from here on (its header no longer matches)
+        self._start_undo_log()
+        return {"memmap": os.path.abspath(self.path), "generation": self.generation}
+
+
+class SumTree(object):
+    """Binary sum tree over n nonnegative weights stored as one flat tensor (node i has children
+    2i and 2i + 1, leaves start at capacity). Batched sampling and updates take O(log n)
+    vectorized steps.
+    """
+
+    def __init__(self, n, device):
+        self.n = n
+        self.capacity = 1 << (n - 1).bit_length()
+        self.depth = self.capacity.bit_length() - 1
+        self.tree = t.zeros(2 * self.capacity, dtype=t.float64, device=device)
+
+    def leaves(self):
+        return self.tree[self.capacity:self.capacity + self.n]
+
+    def set_all(self, values):
+        self.tree[self.capacity:self.capacity + self.n] = values
+        lo = self.capacity
+        while lo > 1:
+            self.tree[lo // 2:lo] = self.tree[lo:2 * lo:2] + self.tree[lo + 1:2 * lo:2]
+            lo //= 2
+
+    def set(self, inds, values):
+        node = inds + self.capacity
+        self.tree[node] = values.to(self.tree.dtype)
+        for _ in range(self.depth):
+            node = node // 2
+            self.tree[node] = self.tree[2 * node] + self.tree[2 * node + 1]
+
+    def sample(self, bs):
+        u = t.rand(bs, dtype=t.float64, device=self.tree.device) * self.tree[1]
+        node = t.ones(bs, dtype=t.long, device=self.tree.device)
+        for _ in range(self.depth):
+            left = self.tree[2 * node]
+            go_right = u >= left
+            u = t.where(go_right, u - left, u)
+            node = 2 * node + go_right.long()
+        return (node - self.capacity).clamp(max=self.n - 1)
+
+
+class PrioritizedReplayBuffer(ReplayBuffer):
+    """Replay buffer whose unconditional draws are weighted by a priority kept in a SumTree,
+    so each draw costs O(log N) even for N ~ 10^6.
+
+    priority="age": weight exp(age_decay * age), where age counts write-backs since the row
+    was last refreshed. Ratios between rows only depend on when they were written, so only the
+    written leaves change; leaves are rescaled once the exponent grows large.
+    priority="energy": weight |energy_ref - f(x)| ** alpha, the gap between a row's f at the
+    end of its last chain and energy_ref (set by the trainer to f on data; the batch mean if
+    unset), so chains furthest from the data get advanced first.
+    Class-conditional draws stay uniform within the class.
+    """
+
+    def __init__(self, buffer, init_fn, reinit_freq=.05, n_classes=None, device=None, priority="age",
+                 alpha=1., age_decay=1e-3):
+        super(PrioritizedReplayBuffer, self).__init__(buffer, init_fn, reinit_freq=reinit_freq,
+                                                      n_classes=n_classes, device=device)
+        assert priority in ("age", "energy"), "Unknown replay buffer priority {}".format(priority)
+        self.priority = priority
+        self.alpha = alpha
+        self.age_decay = age_decay
+        self.energy_ref = None
+        self.step = 0
+        self.ref_step = 0
+        self.tree = SumTree(len(self), self.device)
+        self.tree.set_all(t.ones(len(self), dtype=t.float64, device=self.device))
+
+    def sample_inds(self, bs, y=None):
+        if y is not None:
+            return super(PrioritizedReplayBuffer, self).sample_inds(bs, y)
+        return self.tree.sample(bs)
+
+    def write(self, inds, samples, energy=None):
+        super(PrioritizedReplayBuffer, self).write(inds, samples)
+        inds = inds.to(self.device)
+        self.step += 1
+        if self.priority == "age":
+            exponent = self.age_decay * (self.step - self.ref_step)
+            if exponent > 30.:
+                # rescale so fresh rows don't underflow; the oldest rows saturate instead of overflowing
+                self.tree.set_all((self.tree.leaves() * math.exp(exponent)).clamp(max=1e250))
+                self.ref_step, exponent = self.step, 0.
+            value = t.full((inds.size(0),), math.exp(-exponent), dtype=t.float64, device=self.device)
+        elif energy is None:
+            return # no energies (e.g. zero-step chains): keep the previous priorities
+        else:
+            energy = energy.detach().to(self.device, t.float64).view(-1)
+            energy_ref = energy.mean() if self.energy_ref is None else self.energy_ref.to(energy)
+            value = (energy_ref - energy).abs().pow(self.alpha) + 1e-6
+        self.tree.set(inds, value)
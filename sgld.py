@@ -0,0 +1,110 @@
+import contextlib
+import functools
+import torch as t, torch.nn as nn
+
+
+def cached_layers(f, key, collect):
+    """collect(f), a list of layers of f, computed once and cached on f under key, so mode
+    switches and segmented forwards don't walk the whole module tree every time.
+    """
+    cache = f.__dict__.setdefault("_layer_cache", {})
+    if key not in cache:
+        cache[key] = collect(f)
+    return cache[key]
+
+
+def invalidate_layers(f):
+    """Drops the layer lists cached on f; call it whenever layers of f are swapped or added
+    (compile_model, loading a checkpoint)."""
+    f.__dict__.pop("_layer_cache", None)
+
+
+def _mode_dependent_modules(f):
+    """Layers of f whose forward depends on .training: norms with running stats and dropout."""
+    return cached_layers(f, "mode_dependent", lambda f: [
+        m for m in f.modules()
+        if isinstance(m, nn.modules.dropout._DropoutNd) or getattr(m, "running_mean", None) is not None])
+
+
+def set_stats_frozen(f, frozen):
+    """Same effect as f.eval() (frozen=True) or f.train() (frozen=False), touching only the
+    layers where the mode matters.
+    """
+    for m in _mode_dependent_modules(f):
+        m.training = not frozen
+
+
+@contextlib.contextmanager
+def sampling_mode(f):
+    """Freezes norm statistics and dropout for one SGLD chain, then puts every layer back in
+    the mode it was in before (so e.g. --eval_mode_except_clf is not undone by sampling).
+    """
+    mods = _mode_dependent_modules(f)
+    modes = [m.training for m in mods]
+    for m in mods:
+        m.training = False
+    try:
+        yield f
+    finally:
+        for m, mode in zip(mods, modes):
+            m.training = mode
+
+
+def _sgld_update(x, f_prime, sgld_lr: float, sgld_std: float):
+    return x + sgld_lr * f_prime + sgld_std * t.randn_like(x)
+
+
+@functools.lru_cache(maxsize=None)
+def get_sgld_update(compile=False):
+    """Returns a fused (compiled) SGLD update x + lr * f_prime + std * noise, or None to
+    use the plain in-place update. Falls back to TorchScript when torch.compile is unavailable.
+    """
+    if not compile:
+        return None
+    if hasattr(t, "compile"):
+        return t.compile(_sgld_update)
+    return t.jit.script(_sgld_update)
+
+
+def sgld_chain(energy_fn, x_init, n_steps, sgld_lr, sgld_std, momentum=None,
+               sgld_momentum=0., update_fn=None, return_energy=False, grad_scale=1.):
+    """Runs n_steps of SGLD ascending energy_fn (the unnormalized log density) from x_init.
+
+    Each step's graph is freed as soon as the input gradient is taken, and x_k is updated
+    in place, so peak memory is that of a single forward/backward regardless of n_steps.
+    If momentum is given it is updated in place (no noise is added, as before).
+    Returns the detached final samples; x_init is never modified. With return_energy, also
+    returns energy_fn at the input of the last step (free, as it is computed anyway).
+    grad_scale multiplies the energy before backprop and divides the gradient after, so input
+    gradients of a network running in fp16 don't underflow. The scale is dynamic: a step whose
+    gradient overflows is redone with half the scale, and skipped (x_k left as is) if it still
+    overflows unscaled, so inf/nan never reach the chains.
+    """
+    x_k = x_init.detach().clone().requires_grad_(True)
+    energy = None
+    check_finite = grad_scale != 1.
+    for k in range(n_steps):
+        energy = energy_fn(x_k)
+        f_prime = t.autograd.grad(energy.sum() * grad_scale, [x_k])[0]
+        if check_finite:
+            while grad_scale > 1. and not t.isfinite(f_prime).all():
+                grad_scale = max(grad_scale / 2., 1.)
+                energy = energy_fn(x_k)
+                f_prime = t.autograd.grad(energy.sum() * grad_scale, [x_k])[0]
+            if not t.isfinite(f_prime).all():
+                continue
+        if grad_scale != 1.:
+            f_prime = f_prime / grad_scale
+        with t.no_grad():
+            if momentum is not None:
+                # Modification to usual momentum to "conserve energy" which should help for sampling
+                momentum.mul_(sgld_momentum).add_(f_prime, alpha=1 - sgld_momentum)
+                x_k.add_(momentum, alpha=sgld_lr)
+            elif update_fn is not None:
+                x_k.copy_(update_fn(x_k, f_prime, sgld_lr, sgld_std))
+            else:
+                x_k.add_(f_prime, alpha=sgld_lr)
+                x_k.add_(t.randn_like(x_k), alpha=sgld_std)
+    if return_energy:
+        return x_k.detach(), energy.detach() if energy is not None else None
+    return x_k.detach()
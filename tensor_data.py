@@ -0,0 +1,219 @@
+import math
+import queue
+import threading
+import numpy as np
+import torch as t, torch.nn as nn, torch.nn.functional as tnnF
+
+
+class TensorLoader(object):
+    """Minibatches over tensors that live on one device, without workers or per-item indexing.
+
+    Every epoch draws one randperm and gathers the tensors once; batches are then contiguous
+    slices (views) of the shuffled copy. Iterating gives one epoch like a DataLoader, and
+    next() keeps going across epochs like the old FastLoader, so the same object serves as
+    dload_train or dload_train_labeled. If given, transform is applied to each batch of the
+    first tensor (e.g. a BatchTransform over cached uint8 images).
+    """
+
+    def __init__(self, tensors, batch_size, device=None, shuffle=True, drop_last=True, transform=None):
+        self.tensors = [x.to(device) if device is not None else x for x in tensors]
+        self.transform = transform
+        self.n = self.tensors[0].size(0)
+        assert all(x.size(0) == self.n for x in self.tensors)
+        self.batch_size = max(1, min(batch_size, self.n))
+        self.shuffle = shuffle
+        self.drop_last = drop_last
+        self._stream = None
+
+    def __len__(self):
+        if self.drop_last:
+            return self.n // self.batch_size
+        return (self.n + self.batch_size - 1) // self.batch_size
+
+    def _epoch(self):
+        if self.shuffle:
+            perm = t.randperm(self.n, device=self.tensors[0].device)
+            tensors = [x[perm] for x in self.tensors]
+        else:
+            tensors = self.tensors
+        for i in range(len(self)):
+            batch = tuple(x[i * self.batch_size:(i + 1) * self.batch_size] for x in tensors)
+            if self.transform is not None:
+                batch = (self.transform(batch[0]),) + batch[1:]
+            yield batch
+
+    def __iter__(self):
+        return self._epoch()
+
+    def __next__(self):
+        while True:
+            if self._stream is None:
+                self._stream = self._epoch()
+            try:
+                return next(self._stream)
+            except StopIteration:
+                self._stream = None
+
+
+def dataset_tensors(dset):
+    """Decodes a torchvision MNIST/CIFAR/SVHN dataset once into (uint8 NCHW images, long labels)
+    straight from its arrays, without going through __getitem__.
+    """
+    data = t.as_tensor(np.asarray(dset.data))
+    if data.dim() == 3: # MNIST: N x H x W
+        data = data[:, None]
+    elif data.size(-1) == 3: # CIFAR: N x H x W x C
+        data = data.permute(0, 3, 1, 2)
+    labels = dset.labels if hasattr(dset, "labels") else dset.targets
+    return data.contiguous(), t.as_tensor(np.asarray(labels)).long()
+
+
+class LogitTransform(nn.Module):
+    """Dequantizes pixels in [0, 1] (values k / (precision - 1)) with uniform noise, squeezes them
+    into [clipping, 1 - clipping] and applies the logit. Works on single images or whole batches.
+    """
+
+    def __init__(self, precision=256., clipping=0.05, dequantize=True):
+        super(LogitTransform, self).__init__()
+        assert precision >= 2.0
+        self.precision = precision
+        self.clipping = clipping
+        self.dequantize = dequantize
+
+    def forward(self, x):
+        if self.dequantize:
+            x = (x * (self.precision - 1) + t.rand_like(x)) / self.precision # noise for smoothness
+        x = self.clipping + (1 - 2.0 * self.clipping) * x # clipping to avoid explosion at ends
+        return t.log(x) - t.log(1.0 - x)
+
+    def inverse(self, y):
+        """Maps logit-space values back to pixels in [0, 1]. Exact for outputs of forward on
+        quantized pixels (the dequantization noise is floored away); anything else, e.g. SGLD
+        samples, is clamped to the pixel range first.
+        """
+        x = ((t.sigmoid(y) - self.clipping) / (1 - 2.0 * self.clipping)).clamp(0., 1.)
+        if self.dequantize:
+            x = (x * self.precision).floor().clamp(max=self.precision - 1) / (self.precision - 1)
+        return x
+
+    def log_det(self, y):
+        """Per-sample log |det dy/du| of the squeeze-and-logit map at outputs y, where u are the
+        dequantized values in [0, 1].
+        """
+        log_det = math.log(1 - 2.0 * self.clipping) + tnnF.softplus(y) + tnnF.softplus(-y)
+        return log_det.view(y.size(0), -1).sum(1)
+
+
+class BatchTransform(object):
+    """The per-image train/test pipelines of get_data (Pad, RandomCrop, RandomHorizontalFlip,
+    ToTensor, Normalize or logit_transform, Gaussian noise) as batched tensor ops on uint8
+    image batches, so they run on the device instead of in PIL inside loader workers.
+    """
+
+    def __init__(self, pad=0, pad_mode="constant", crop=False, flip=False, normalize=False,
+                 logit_precision=None, sigma=0.):
+        self.pad = pad
+        self.pad_mode = pad_mode
+        self.crop = crop
+        self.flip = flip
+        self.normalize = normalize
+        self.logit = LogitTransform(logit_precision) if logit_precision is not None else None
+        self.sigma = sigma
+
+    def random_crop(self, x):
+        n, c, h, w = x.shape
+        x = tnnF.pad(x, [self.pad] * 4, mode=self.pad_mode)
+        oy = t.randint(0, 2 * self.pad + 1, (n, 1), device=x.device) + t.arange(h, device=x.device)
+        ox = t.randint(0, 2 * self.pad + 1, (n, 1), device=x.device) + t.arange(w, device=x.device)
+        # advanced indexing moves the channel dim last
+        x = x[t.arange(n, device=x.device)[:, None, None], :, oy[:, :, None], ox[:, None, :]]
+        return x.permute(0, 3, 1, 2)
+
+    def __call__(self, x):
+        x = x.float().div_(255.)
+        if self.crop:
+            x = self.random_crop(x)
+        if self.flip:
+            flip = t.rand(x.size(0), device=x.device) < .5
+            x = t.where(flip[:, None, None, None], x.flip(3), x)
+        if self.logit is not None:
+            x = self.logit(x)
+        elif self.normalize:
+            x = (x - .5) / .5
+        if self.sigma > 0:
+            x = x + self.sigma * t.randn_like(x)
+        return x
+
+
+def paired_batches(dload_train, dload_train_labeled):
+    """One epoch of dload_train, each batch paired with the next labeled batch:
+    yields (x_p_d, y_p_d, x_lab, y_lab).
+    """
+    for x_p_d, y_p_d in dload_train:
+        x_lab, y_lab = dload_train_labeled.__next__()
+        yield x_p_d, y_p_d, x_lab, y_lab
+
+
+class DevicePrefetcher(object):
+    """Iterates over batches (tuples of tensors) already moved to device, fetching the next
+    batch while the current one is in use.
+
+    On CUDA the next batch is copied from pinned memory on a side stream, so the copy overlaps
+    with compute on the default stream (e.g. the SGLD chain). Without a GPU a background
+    thread fetches batches ahead, overlapping loader work instead.
+    """
+
+    def __init__(self, batches, device, depth=2):
+        self.batches = iter(batches)
+        self.device = t.device(device)
+        if self.device.type == "cuda":
+            self.stream = t.cuda.Stream(device=self.device)
+            self._next = self._preload()
+        else:
+            self.stream = None
+            self.queue = queue.Queue(maxsize=depth)
+            self.thread = threading.Thread(target=self._fill, daemon=True)
+            self.thread.start()
+
+    def _to_device(self, x):
+        if x.device == self.device:
+            return x
+        if x.device.type == "cpu" and not x.is_pinned():
+            x = x.pin_memory()
+        return x.to(self.device, non_blocking=True)
+
+    def _preload(self):
+        try:
+            batch = next(self.batches)
+        except StopIteration:
+            return None
+        with t.cuda.stream(self.stream):
+            return tuple(self._to_device(x) for x in batch)
+
+    def _fill(self):
+        try:
+            for batch in self.batches:
+                self.queue.put(tuple(self._to_device(x) for x in batch))
+        except Exception as e:
+            self.queue.put(e)
+        self.queue.put(None)
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        if self.stream is None:
+            batch = self.queue.get()
+            if isinstance(batch, Exception):
+                raise batch
+        else:
+            batch = self._next
+            if batch is not None:
+                current = t.cuda.current_stream(self.device)
+                current.wait_stream(self.stream)
+                for x in batch:
+                    x.record_stream(current) # don't let the side stream's allocator reuse it early
+                self._next = self._preload()
+        if batch is None:
+            raise StopIteration
+        return batch
@@ -15,11 +15,11 @@
 
 import utils
 import torch as t, torch.nn as nn, torch.nn.functional as tnnF, torch.distributions as tdist
-from torch.utils.data import DataLoader, Dataset
 import torchvision as tv, torchvision.transforms as tr
 import os
 import sys
 import argparse
+import functools
 #import ipdb
 import numpy as np
 import wideresnet
@@ -36,6 +36,15 @@ from vbnorm import VirtualBatchNormNN
 from losses import VATLoss, LDSLoss, sliced_score_matching_vr, \
     sliced_score_matching, denoising_score_matching
 import regression_datasets
+import sgld
+import dist_utils
+from export_model import export_model
+from data_registry import DatasetRegistry, get_split_inds, split_cache_path, make_loader
+from tensor_data import TensorLoader, BatchTransform, LogitTransform, DevicePrefetcher, dataset_tensors, \
+    paired_batches
+from replay_buffer import ReplayBuffer, PinnedReplayBuffer, MemmapReplayBuffer, QuantizedReplayBuffer, \
+    PrioritizedReplayBuffer, \
+    load_buffer_state
 from matplotlib.colors import ListedColormap
 
 
@@ -43,19 +52,26 @@ import toy_data
 TOY_DSETS = ("moons", "circles", "8gaussians", "pinwheel", "2spirals", "checkerboard", "rings", "swissroll")
 REG_DSETS = {"concrete": 8, "protein": 9, "navy": 16, "power_plant": 4, "year": 90}
 
-class DataSubset(Dataset):
-    def __init__(self, base_dataset, inds=None, size=-1):
-        self.base_dataset = base_dataset
-        if inds is None:
-            inds = np.random.choice(list(range(len(base_dataset))), size, replace=False)
-        self.inds = inds
 
-    def __getitem__(self, index):
-        base_ind = self.inds[index]
-        return self.base_dataset[base_ind]
+class ModelConfig(object):
+    """Architecture options of F/CCF and their NeuralNet/ConvLarge backbones. The model classes
+    take it explicitly instead of reading the global args, so they can be built, pickled and
+    exported outside of this script. Options that aren't given keep their command line defaults.
+    """
+    defaults = dict(n_ch=3, nn_hidden_size=500, nn_extra_layers=2, vbnorm=False, batch_norm=False,
+                    no_param_bn=False, first_layer_bn_only=False, dropout=False, swish=False, sine=False,
+                    softplus=False, leaky_relu=False, cnn_no_bn=False, cnn_no_dropout=False,
+                    cnn_avg_pool_kernel=6, grad_checkpoint=False)
 
-    def __len__(self):
-        return len(self.inds)
+    def __init__(self, **options):
+        unknown = set(options) - set(self.defaults)
+        assert not unknown, "Unknown model options {}".format(sorted(unknown))
+        self.__dict__.update(self.defaults)
+        self.__dict__.update(options)
+
+    @classmethod
+    def from_args(cls, args):
+        return cls(**{name: getattr(args, name) for name in cls.defaults if hasattr(args, name)})
 
 
 class Swish(nn.Module):
@@ -80,19 +96,21 @@ class Sine(nn.Module):
 
 
 class NeuralNet(nn.Module):
-    def __init__(self, input_size, hidden_size, extra_layers, use_vbnorm=False, ref_x=None, n_channels_in=1):
+    def __init__(self, input_size, hidden_size, extra_layers, use_vbnorm=False, ref_x=None, n_channels_in=1,
+                 config=None):
         super(NeuralNet, self).__init__()
+        config = ModelConfig() if config is None else config
         self.layers = nn.ModuleList()
         self.use_vbnorm = use_vbnorm
 
         self.n_channels_in = n_channels_in
 
         affine = True
-        if args.no_param_bn:
+        if config.no_param_bn:
             affine = False
 
         layer_in = nn.Linear(input_size * n_channels_in, hidden_size)
-        if args.sine:
+        if config.sine:
             unif_bound = np.sqrt(6.0 / input_size)
             first_layer_scalar = 30
             nn.init.uniform_(layer_in.weight, -unif_bound, unif_bound) * first_layer_scalar
@@ -102,52 +120,52 @@ class NeuralNet(nn.Module):
         if use_vbnorm:
             assert ref_x is not None
             self.layers.append(VirtualBatchNormNN(hidden_size))
-        elif args.batch_norm:
+        elif config.batch_norm:
             self.layers.append(nn.BatchNorm1d(num_features=hidden_size, affine=affine))
 
-        if args.swish:
+        if config.swish:
             self.layers.append(Swish(hidden_size))
-        elif args.sine:
+        elif config.sine:
             self.layers.append(Sine())
-        elif args.softplus:
+        elif config.softplus:
             self.layers.append(nn.Softplus())
-        elif args.leaky_relu:
+        elif config.leaky_relu:
             self.layers.append(nn.LeakyReLU())
         else:
             self.layers.append(nn.ReLU())
 
-        if args.dropout:
+        if config.dropout:
             self.layers.append(nn.Dropout(p=0.5))
 
         for i in range(extra_layers):
             layer = nn.Linear(hidden_size, hidden_size)
-            if args.sine:
+            if config.sine:
                 nn.init.uniform_(layer.weight, -unif_bound, unif_bound)
             self.layers.append(layer)
             # self.layers.append(nn.Linear(hidden_size, hidden_size))
-            if not args.first_layer_bn_only:
+            if not config.first_layer_bn_only:
                 if use_vbnorm:
                     self.layers.append(VirtualBatchNormNN(hidden_size))
-                elif args.batch_norm:
+                elif config.batch_norm:
                     self.layers.append(nn.BatchNorm1d(num_features=hidden_size, affine=affine))
-            if args.swish:
+            if config.swish:
                 self.layers.append(Swish(hidden_size))
-            elif args.sine:
+            elif config.sine:
                 self.layers.append(Sine())
-            elif args.softplus:
+            elif config.softplus:
                 self.layers.append(nn.Softplus())
-            elif args.leaky_relu:
+            elif config.leaky_relu:
                 self.layers.append(nn.LeakyReLU())
             else:
                 self.layers.append(nn.ReLU())
-            if args.dropout:
+            if config.dropout:
                 self.layers.append(nn.Dropout(p=0.5))
 
         # Note output layer not needed here because it is done in class F
 
 
     def forward(self, x, y=None):
-        if args.vbnorm:
+        if self.use_vbnorm:
             ref_x = self.ref_x
             if len(ref_x.shape) > 2:
                 if self.n_channels_in > 1:
@@ -167,7 +185,7 @@ class NeuralNet(nn.Module):
             elif isinstance(layer, nn.BatchNorm1d):
                 x = layer(x)
             else: # now includes ReLU/activation functions
-                if args.vbnorm:
+                if self.use_vbnorm:
                     ref_x = layer(ref_x)
                 x = layer(x)
         output = x
@@ -195,23 +213,25 @@ def conv_swish_block(channels, n_units, kernel, padding):
 
 class ConvLarge(nn.Module):
     # Based on VAT paper, what they call "ConvLarge"
-    def __init__(self, avg_pool_kernel=6):
+    def __init__(self, avg_pool_kernel=6, config=None):
         super(ConvLarge, self).__init__()
+        config = ModelConfig() if config is None else config
+        self.grad_checkpoint = config.grad_checkpoint
         self.layers = nn.ModuleList()
 
-        if args.swish:
-            self.layers.append(conv_swish_block(args.n_ch, n_units=128, kernel=3,
+        if config.swish:
+            self.layers.append(conv_swish_block(config.n_ch, n_units=128, kernel=3,
                                  padding=1))
             self.layers.append(conv_swish_block(128, 128, kernel=3, padding=1))
             self.layers.append(conv_swish_block(128, 128, kernel=3, padding=1))
             self.layers.append(nn.MaxPool2d(kernel_size=2, stride=2))
-            if not args.cnn_no_dropout:
+            if not config.cnn_no_dropout:
                 self.layers.append(nn.Dropout2d(p=0.5))
             self.layers.append(conv_swish_block(128, 256, kernel=3, padding=1))
             self.layers.append(conv_swish_block(256, 256, kernel=3, padding=1))
             self.layers.append(conv_swish_block(256, 256, kernel=3, padding=1))
             self.layers.append(nn.MaxPool2d(kernel_size=2, stride=2))
-            if not args.cnn_no_dropout:
+            if not config.cnn_no_dropout:
                 self.layers.append(nn.Dropout2d(p=0.5))
             self.layers.append(
                 conv_swish_block(256, 512, kernel=3, padding=0))
@@ -220,20 +240,20 @@ class ConvLarge(nn.Module):
             self.layers.append(
                 conv_swish_block(256, 128, kernel=1, padding=0))
         else:
-            if args.cnn_no_bn:
-                self.layers.append(conv_lrelu_block(args.n_ch, n_units=128, kernel=3,
+            if config.cnn_no_bn:
+                self.layers.append(conv_lrelu_block(config.n_ch, n_units=128, kernel=3,
                                         padding=1))
                 self.layers.append(conv_lrelu_block(128, 128, kernel=3, padding=1))
                 self.layers.append(conv_lrelu_block(128, 128, kernel=3, padding=1))
             else:
-                self.layers.append(conv_lrelu_bn_block(args.n_ch, n_units=128, kernel=3,
+                self.layers.append(conv_lrelu_bn_block(config.n_ch, n_units=128, kernel=3,
                                     padding=1))
                 self.layers.append(conv_lrelu_bn_block(128, 128, kernel=3, padding=1))
                 self.layers.append(conv_lrelu_bn_block(128, 128, kernel=3, padding=1))
             self.layers.append(nn.MaxPool2d(kernel_size=2, stride=2))
-            if not args.cnn_no_dropout:
+            if not config.cnn_no_dropout:
                 self.layers.append(nn.Dropout2d(p=0.5))
-            if args.cnn_no_bn:
+            if config.cnn_no_bn:
                 self.layers.append(conv_lrelu_block(128, 256, kernel=3, padding=1))
                 self.layers.append(conv_lrelu_block(256, 256, kernel=3, padding=1))
                 self.layers.append(conv_lrelu_block(256, 256, kernel=3, padding=1))
@@ -242,9 +262,9 @@ class ConvLarge(nn.Module):
                 self.layers.append(conv_lrelu_bn_block(256, 256, kernel=3, padding=1))
                 self.layers.append(conv_lrelu_bn_block(256, 256, kernel=3, padding=1))
             self.layers.append(nn.MaxPool2d(kernel_size=2, stride=2))
-            if not args.cnn_no_dropout:
+            if not config.cnn_no_dropout:
                 self.layers.append(nn.Dropout2d(p=0.5))
-            if args.cnn_no_bn:
+            if config.cnn_no_bn:
                 self.layers.append(
                     conv_lrelu_block(256, 512, kernel=3, padding=0))
                 self.layers.append(
@@ -265,36 +285,46 @@ class ConvLarge(nn.Module):
         self.layers = nn.Sequential(*self.layers)
 
     def forward(self, x):
-        out = self.layers(x)
+        if self.grad_checkpoint:
+            out = x
+            for layer in self.layers:
+                # the conv blocks hold the large activations; pooling and dropout run as usual
+                out = wideresnet.checkpointed(layer, layer, out) if isinstance(layer, nn.Sequential) else layer(out)
+        else:
+            out = self.layers(x)
         out = out.squeeze()
         return out
 
 
 class F(nn.Module):
-    def __init__(self, depth=28, width=2, norm=None, dropout_rate=0.0, im_sz=32, use_nn=False, input_size=None, n_classes=10, ref_x=None, use_cnn=False):
+    def __init__(self, depth=28, width=2, norm=None, dropout_rate=0.0, im_sz=32, use_nn=False, input_size=None, n_classes=10, ref_x=None, use_cnn=False,
+                 config=None):
         if input_size is not None:
             assert use_nn == True #input size is for non-images, ie non-conv.
         super(F, self).__init__()
+        config = ModelConfig() if config is None else config
         # print(input_size)
         if use_cnn:
             print("Using ConvLarge")
-            self.f = ConvLarge(avg_pool_kernel=args.cnn_avg_pool_kernel)
+            self.f = ConvLarge(avg_pool_kernel=config.cnn_avg_pool_kernel, config=config)
             self.f.last_dim = 128
         elif use_nn:
-            hidden_units = args.nn_hidden_size
+            hidden_units = config.nn_hidden_size
 
             use_vbnorm = False
-            if args.vbnorm:
+            if config.vbnorm:
                 use_vbnorm = True
 
             if input_size is None:
                 input_size = im_sz**2
                 # self.f = NeuralNet(im_sz**2, hidden_units, extra_layers=args.nn_extra_layers, use_vbnorm=use_vbnorm, ref_x=ref_x, n_channels_in=args.n_ch)
             # else:
-            self.f = NeuralNet(input_size, hidden_units, extra_layers=args.nn_extra_layers, use_vbnorm=use_vbnorm, ref_x=ref_x, n_channels_in=args.n_ch)
+            self.f = NeuralNet(input_size, hidden_units, extra_layers=config.nn_extra_layers, use_vbnorm=use_vbnorm, ref_x=ref_x, n_channels_in=config.n_ch,
+                               config=config)
             self.f.last_dim = hidden_units
         else:
-            self.f = wideresnet.Wide_ResNet(depth, width, norm=norm, dropout_rate=dropout_rate, input_channels=args.n_ch)
+            self.f = wideresnet.Wide_ResNet(depth, width, norm=norm, dropout_rate=dropout_rate, input_channels=config.n_ch,
+                                            grad_checkpoint=config.grad_checkpoint)
 
         self.energy_output = nn.Linear(self.f.last_dim, 1)
         self.class_output = nn.Linear(self.f.last_dim, n_classes)
@@ -315,10 +345,10 @@ class F(nn.Module):
 
 class CCF(F):
     def __init__(self, depth=28, width=2, norm=None, dropout_rate=0.0, im_sz=32,
-                 use_nn=False, input_size=None, n_classes=10, ref_x=None, use_cnn=False):
+                 use_nn=False, input_size=None, n_classes=10, ref_x=None, use_cnn=False, config=None):
         super(CCF, self).__init__(depth, width, norm=norm, dropout_rate=dropout_rate,
                                   n_classes=n_classes, im_sz=im_sz, input_size=input_size,
-                                  use_nn=use_nn, ref_x=ref_x, use_cnn=use_cnn)
+                                  use_nn=use_nn, ref_x=ref_x, use_cnn=use_cnn, config=config)
 
     def forward(self, x, y=None):
         logits = self.classify(x)
@@ -327,6 +357,132 @@ class CCF(F):
         else:
             return t.gather(logits, 1, y[:, None])
 
+    def classify_segments(self, xs, modes):
+        """Logits for each batch in xs from a single backbone pass over their concatenation.
+        Layers whose output depends on the rest of the batch (norms with running stats, dropout,
+        as in sgld.sampling_mode, plus ActNorm before its data-dependent init) still process every
+        batch on its own, in the mode given for it in modes (None keeps the layer's current mode),
+        so batch statistics and running stat updates are the same as calling classify on each
+        batch in turn.
+        """
+        sizes = [x.size(0) for x in xs]
+        mods = sgld.cached_layers(self, "segmented", _segmented_modules)
+        for m in mods:
+            m.forward = _segmented_forward(m, sizes, modes)
+        try:
+            logits = self.class_output(self.f(t.cat(xs)))
+        finally:
+            for m in mods:
+                del m.forward
+        return list(logits.split(sizes))
+
+
+def _segmented_modules(f):
+    mods = list(sgld._mode_dependent_modules(f))
+    # ActNorm (an "initialized" buffer) only depends on the batch until its data-dependent init,
+    # running it per batch after that is harmless
+    mods += [m for m in f.modules() if m not in mods and
+             (isinstance(m, nn.modules.batchnorm._BatchNorm) or getattr(m, "initialized", None) is not None)]
+    # scripted layers (batchrenorm.BatchRenorm) ignore a patched forward, and virtual batch
+    # norm takes the reference batch statistics as extra arguments
+    for m in f.modules():
+        assert not (m in mods and isinstance(m, t.jit.ScriptModule)) and not isinstance(m, VirtualBatchNormNN), \
+            "{} can't run per batch in a joint forward pass".format(type(m).__name__)
+    return mods
+
+
+def _segmented_forward(m, sizes, modes):
+    forward = type(m).forward
+
+    def segmented_forward(x):
+        training = m.training
+        outs = []
+        for x_s, mode in zip(x.split(sizes), modes):
+            m.training = training if mode is None else mode
+            outs.append(forward(m, x_s))
+        m.training = training
+        return t.cat(outs)
+
+    return segmented_forward
+
+
+class JointForward(object):
+    """Collects the batches one training step pushes through a CCF, runs the backbone once on all
+    of them (see CCF.classify_segments) and hands back each batch's logits. Every add gets its own
+    segment, even for a tensor added before (e.g. x_p_d for p(x) and --ent_min), so norm running
+    stats get one update per term, as with separate forward passes.
+    """
+
+    def __init__(self, f):
+        self.f = f
+        self.xs, self.modes = [], []
+        self.logits = None
+
+    def add(self, x, training=None):
+        self.xs.append(x)
+        self.modes.append(training)
+        return len(self.xs) - 1
+
+    def run(self):
+        self.logits = self.f.classify_segments(self.xs, self.modes)
+        return self
+
+    def classify(self, k):
+        return self.logits[k]
+
+    def energy(self, k, y=None):
+        if y is None:
+            return self.logits[k].logsumexp(1)
+        return t.gather(self.logits[k], 1, y[:, None])
+
+
+def make_grad_scaler(amp):
+    """GradScaler for fp16 autocast, disabled otherwise. torch.amp.GradScaler where it exists,
+    the (since deprecated) torch.cuda.amp one on older torch."""
+    enabled = amp == "fp16"
+    if hasattr(t, "amp") and hasattr(t.amp, "GradScaler"):
+        return t.amp.GradScaler("cuda", enabled=enabled)
+    return t.cuda.amp.GradScaler(enabled=enabled)
+
+
+def autocast_model(f, device, amp):
+    """Runs f's forward, classify and classify_segments under autocast with amp ("bf16" or
+    "fp16") and casts their outputs back to fp32, so losses, energies and the SGLD updates of
+    x_k stay in full precision while the backbone runs in half precision.
+    """
+    dtype = t.bfloat16 if amp == "bf16" else t.float16
+    device_type = t.device(device).type
+
+    def to_float(out):
+        if isinstance(out, (list, tuple)):
+            return type(out)(o.float() for o in out)
+        return out.float()
+
+    def wrap(method):
+        @functools.wraps(method)
+        def autocast_method(*args, **kwargs):
+            with t.autocast(device_type=device_type, dtype=dtype):
+                return to_float(method(*args, **kwargs))
+        return autocast_method
+
+    for name in ("forward", "classify", "classify_segments"):
+        if hasattr(f, name):
+            setattr(f, name, wrap(getattr(f, name)))
+    return f
+
+
+def compile_model(f):
+    """Compiles f's forward and classify with torch.compile, so small models (e.g. the toy MLPs)
+    aren't dominated by Python dispatch in the training losses and SGLD steps.
+    """
+    if not hasattr(t, "compile"):
+        print("torch.compile is not available, running the model eagerly")
+        return f
+    for name in ("forward", "classify"):
+        setattr(f, name, t.compile(getattr(f, name)))
+    sgld.invalidate_layers(f)
+    return f
+
 
 def cond_entropy(logits):
     probs = t.softmax(logits, dim=1)
@@ -340,18 +496,19 @@ def cycle(loader):
             yield data
 
 
-class FastLoader:
-    def __init__(self, dataset, batch_size):
-        self.dataset = dataset
-        self.dataset_size = self.dataset[0].size(0)
-        self.batch_size = batch_size
-
-    def __next__(self):
-        all_inds = np.array(list(range(self.dataset_size)))
-        inds = np.random.choice(all_inds, self.batch_size, replace=False)
-        inds = t.from_numpy(inds).long()
-        batch = self.dataset[0][inds], self.dataset[1][inds] # data, labels
-        return batch
+def micro_batches(batch, n):
+    """Splits every tensor of batch (None entries are passed along) into n equal slices and
+    yields the n tuples of slices. Every tensor's size has to be divisible by n (labeled batches
+    can be smaller than --batch_size), so per-slice means average to the full-batch means."""
+    if n == 1:
+        yield batch
+        return
+    for x in batch:
+        assert x is None or x.size(0) % n == 0, \
+            "--micro_batches {} has to divide every batch of the step, got a batch of {}".format(n, x.size(0))
+    slices = [x.split(x.size(0) // n) if x is not None else [None] * n for x in batch]
+    for mb in zip(*slices):
+        yield mb
 
 
 def grad_norm(m):
@@ -374,13 +531,13 @@ def grad_vals(m):
     return ps.mean().item(), ps.std(), ps.abs().mean(), ps.abs().std(), ps.abs().min(), ps.abs().max()
 
 
-def init_random(args, bs):
+def init_random(args, bs, device=None):
     if (args.dataset == "moons" or args.dataset == "rings") or args.dataset in REG_DSETS:
-        out = t.FloatTensor(bs, args.input_size).uniform_(-1,1) / args.temper_init
+        out = t.empty(bs, args.input_size, device=device).uniform_(-1,1) / args.temper_init
     elif args.dataset == "mnist":
-        out = t.FloatTensor(bs, args.n_ch, args.im_sz, args.im_sz).uniform_(-3, 3) / args.temper_init
+        out = t.empty(bs, args.n_ch, args.im_sz, args.im_sz, device=device).uniform_(-3, 3) / args.temper_init
     else:
-        out = t.FloatTensor(bs, args.n_ch, args.im_sz, args.im_sz).uniform_(-1, 1) / args.temper_init
+        out = t.empty(bs, args.n_ch, args.im_sz, args.im_sz, device=device).uniform_(-1, 1) / args.temper_init
     return out
 
 
@@ -400,42 +557,143 @@ def get_model_and_buffer(args, device, ref_x=None):
         assert args.use_nn
     f = model_cls(args.depth, args.width, args.norm, dropout_rate=args.dropout_rate,
                   n_classes=args.n_classes, im_sz=args.im_sz, input_size=args.input_size,
-                  use_nn=args.use_nn, ref_x=ref_x, use_cnn=args.use_cnn)
-    if not args.uncond:
-        assert args.buffer_size % args.n_classes == 0, "Buffer size must be divisible by args.n_classes"
+                  use_nn=args.use_nn, ref_x=ref_x, use_cnn=args.use_cnn, config=ModelConfig.from_args(args))
+    buffer_labels = None
+    # in distributed runs each rank keeps the chains buffer[rank::world_size]
+    assert args.buffer_size % args.world_size == 0, "--buffer_size must be divisible by the number of ranks"
+    buffer_size = args.buffer_size // args.world_size
     if args.load_path is None:
         # make replay buffer
-        replay_buffer = init_random(args, args.buffer_size)
+        if args.buffer_backend == "memmap":
+            replay_buffer = buffer_size # filled on disk chunk by chunk
+        else:
+            replay_buffer = init_random(args, buffer_size)
     else:
         print(f"loading model from {args.load_path}")
         ckpt_dict = t.load(args.load_path)
         f.load_state_dict(ckpt_dict["model_state_dict"])
-        replay_buffer = ckpt_dict["replay_buffer"]
+        sgld.invalidate_layers(f)
+        replay_buffer, buffer_labels = load_buffer_shard(args, ckpt_dict)
 
     f = f.to(device)
 
+    buffer_init_fn = lambda bs, device: init_random(args, bs, device)
+    if args.buffer_storage != "float32":
+        assert args.buffer_backend in ("device", "cpu"), "Compressed buffer storage needs --buffer_backend device or cpu"
+        assert not args.optim_sgld, "Can't optimize a compressed replay buffer with --optim_sgld"
+    if args.buffer_priority != "none":
+        assert args.buffer_backend in ("device", "cpu") and args.buffer_storage == "float32", \
+            "Prioritized sampling needs a float32 --buffer_backend device or cpu buffer"
+    if args.buffer_backend == "memmap":
+        # the optimizer would write the mapping directly, around the undo log
+        assert not args.optim_sgld, "Can't optimize a memmap replay buffer with --optim_sgld"
+    if args.world_size > 1 and args.buffer_backend == "memmap":
+        assert args.ckpt_buffer_shards, "A distributed memmap buffer has to be checkpointed with --ckpt_buffer_shards"
+    if args.buffer_backend == "memmap":
+        # a checkpoint reference is copied into save_dir, or rolled back and reopened in place if it
+        # already lives there
+        memmap_name = "replay_buffer.npy" if args.world_size == 1 else "replay_buffer_rank{}.npy".format(args.rank)
+        replay_buffer = MemmapReplayBuffer(os.path.join(args.save_dir, memmap_name), buffer_init_fn,
+                                           reinit_freq=args.reinit_freq, n_classes=args.n_classes,
+                                           buffer=replay_buffer)
+    elif args.buffer_backend == "pinned":
+        replay_buffer = load_buffer_state(replay_buffer)
+        replay_buffer = PinnedReplayBuffer(replay_buffer, buffer_init_fn, reinit_freq=args.reinit_freq,
+                                           n_classes=args.n_classes, device=device)
+    else:
+        replay_buffer = load_buffer_state(replay_buffer)
+        buffer_device = device if args.buffer_backend == "device" else "cpu"
+        if args.buffer_priority != "none":
+            replay_buffer = PrioritizedReplayBuffer(replay_buffer, buffer_init_fn, reinit_freq=args.reinit_freq,
+                                                    n_classes=args.n_classes, device=buffer_device,
+                                                    priority=args.buffer_priority, alpha=args.buffer_priority_alpha,
+                                                    age_decay=args.buffer_age_decay)
+        elif args.buffer_storage != "float32":
+            replay_buffer = QuantizedReplayBuffer(replay_buffer, buffer_init_fn, reinit_freq=args.reinit_freq,
+                                                  n_classes=args.n_classes, device=buffer_device,
+                                                  storage=args.buffer_storage)
+        else:
+            replay_buffer = ReplayBuffer(replay_buffer, buffer_init_fn, reinit_freq=args.reinit_freq,
+                                         n_classes=args.n_classes, device=buffer_device)
+
+    if buffer_labels is not None and not args.uncond:
+        replay_buffer.relabel(buffer_labels)
+
     if args.optim_sgld:
-        replay_buffer = nn.Parameter(replay_buffer)
+        replay_buffer.buffer = nn.Parameter(replay_buffer.buffer)
 
     return f, replay_buffer
 
 
+def load_buffer_shard(args, ckpt_dict):
+    """This rank's (replay buffer, buffer labels) from a checkpoint holding either the whole buffer
+    or the names of per-rank shard files (--ckpt_buffer_shards). Buffers saved with a different
+    number of ranks are reassembled and resharded.
+    """
+    shard_names = ckpt_dict.get("replay_buffer_shards")
+    if shard_names is None:
+        shards = [{"replay_buffer": ckpt_dict["replay_buffer"],
+                   "replay_buffer_labels": ckpt_dict.get("replay_buffer_labels")}]
+    elif len(shard_names) == args.world_size:
+        shard = t.load(os.path.join(os.path.dirname(args.load_path), shard_names[args.rank]))
+        return shard["replay_buffer"], shard.get("replay_buffer_labels")
+    else:
+        shards = [t.load(os.path.join(os.path.dirname(args.load_path), name)) for name in shard_names]
+    if len(shards) == 1 and args.world_size == 1:
+        return shards[0]["replay_buffer"], shards[0].get("replay_buffer_labels")
+    replay_buffer = dist_utils.interleave([load_buffer_state(shard["replay_buffer"]) for shard in shards])
+    replay_buffer = dist_utils.shard(replay_buffer, args.rank, args.world_size)
+    buffer_labels = None
+    if shards[0].get("replay_buffer_labels") is not None:
+        buffer_labels = dist_utils.interleave([shard["replay_buffer_labels"] for shard in shards])
+        buffer_labels = dist_utils.shard(buffer_labels, args.rank, args.world_size)
+    return replay_buffer, buffer_labels
+
+
 def get_model_and_buffer_with_momentum(args, device, ref_x=None):
     f, replay_buffer = get_model_and_buffer(args, device, ref_x)
-    momentum_buffer = t.zeros_like(replay_buffer)
+    momentum_buffer = t.zeros(replay_buffer.buffer.shape, device=replay_buffer.buffer.device)
     return f, replay_buffer, momentum_buffer
 
 
-def logit_transform(x, clipping=0.05):
+def get_logit_transform(args):
+    """The LogitTransform applied to the data, or None if the dataset is used without one."""
+    if (args.dataset == "svhn" and args.svhn_logit_transform) or \
+            (args.dataset == "mnist" and not args.mnist_no_logit_transform):
+        return LogitTransform(args.dequant_precision)
+    return None
+
+
+def get_batch_transforms(args):
+    """Batched equivalents of the train/test transforms in get_data, for --tensor_cache."""
     precision = args.dequant_precision
-    assert precision >= 2.0
-    x = (x * (precision - 1) + t.rand_like(x)) / precision # noise for smoothness
-    x = clipping + (1 - 2.0 * clipping) * x # clipping to avoid explosion at ends
-    x = t.log(x) - t.log(1.0 - x)
-    return x
+    if args.dataset == "svhn":
+        if args.svhn_logit_transform:
+            transform_train = BatchTransform(pad=4, crop=True, logit_precision=precision, sigma=args.sigma)
+        else:
+            transform_train = BatchTransform(pad=4, pad_mode="reflect", crop=True, normalize=True, sigma=args.sigma)
+    elif args.dataset == "mnist":
+        if args.mnist_no_logit_transform:
+            transform_train = BatchTransform()
+        elif args.mnist_no_crop:
+            transform_train = BatchTransform(logit_precision=precision, sigma=args.mnist_sigma)
+        else:
+            transform_train = BatchTransform(pad=4, crop=True, logit_precision=precision, sigma=args.mnist_sigma)
+    else:
+        transform_train = BatchTransform(pad=4, pad_mode="reflect", crop=True, flip=True, normalize=True,
+                                         sigma=args.sigma)
+    if args.dataset == "mnist":
+        if args.mnist_no_logit_transform:
+            transform_test = BatchTransform()
+        else:
+            transform_test = BatchTransform(logit_precision=precision)
+    else:
+        transform_test = BatchTransform(normalize=True, sigma=args.sigma)
+    return transform_train, transform_test
 
 
-def get_data(args):
+def get_data(args, device=None):
+    logit_transform = get_logit_transform(args)
     if args.dataset == "svhn":
         if args.svhn_logit_transform:
             transform_train = tr.Compose(
@@ -528,7 +786,10 @@ def get_data(args):
             labels = labels.long()
             return t.utils.data.TensorDataset(data, labels)
         elif args.dataset in REG_DSETS:
-            tr, te, ddim = regression_datasets.get_data(args.dataset, seed=args.data_seed)
+            if args.stream_tabular:
+                tr, te, ddim = regression_datasets.get_streaming_data(args.dataset, seed=args.data_seed)
+            else:
+                tr, te, ddim = regression_datasets.get_data(args.dataset, seed=args.data_seed)
             if train:
                 return tr
             else:
@@ -539,138 +800,195 @@ def get_data(args):
                                     split="train" if train else "test")
 
 
+    # raw splits are loaded once; every set below is an index view with its own transform
+    registry = DatasetRegistry(dataset_fn)
     # get all training inds
-    full_train = dataset_fn(True, transform_train)
-    all_inds = list(range(len(full_train)))
-    # set seed
-    np.random.seed(args.dataset_seed)
-    # shuffle
-    np.random.shuffle(all_inds)
-    # seperate out validation set
-    if args.n_valid is not None:
-        valid_inds, train_inds = all_inds[:args.n_valid], all_inds[args.n_valid:]
-    else:
-        valid_inds, train_inds = [], all_inds
-    train_inds = np.array(train_inds)
-    train_labeled_inds = []
-    other_inds = []
-
-    train_labels = np.array([full_train[ind][1] for ind in train_inds])
-    if args.labels_per_class > 0:
-        for i in range(args.n_classes):
-            train_labeled_inds.extend(train_inds[train_labels == i][:args.labels_per_class])
-            #
-            other_inds.extend(train_inds[train_labels == i][args.labels_per_class:])
-    else:
-        train_labeled_inds = train_inds
-
-    dset_train = DataSubset(
-        dataset_fn(True, transform_train),
-        inds=train_inds)
+    full_train = registry.raw(True)
+    split_cache = None
+    if args.dataset not in TOY_DSETS and args.dataset not in REG_DSETS:
+        split_cache = split_cache_path(args.data_root, args.dataset, args.dataset_seed, args.n_valid,
+                                       args.labels_per_class)
+    train_inds, valid_inds, train_labeled_inds = get_split_inds(
+        full_train, args.dataset_seed, n_valid=args.n_valid, labels_per_class=args.labels_per_class,
+        n_classes=args.n_classes, cache_path=split_cache)
+    if args.world_size > 1:
+        # every rank trains on its own fixed, equally long slice of the (unlabeled and labeled) training set
+        assert args.labels_per_class <= 0 or args.labels_per_class >= args.world_size, \
+            "--labels_per_class must be at least the number of ranks, or some ranks get no labels of some classes"
+        train_inds = dist_utils.shard(train_inds, args.rank, args.world_size)
+        train_labeled_inds = dist_utils.shard(train_labeled_inds, args.rank, args.world_size)
+
+    if args.tensor_cache:
+        # decode every split once to uint8 on the device; augmentation runs per batch there
+        assert args.dataset in ("mnist", "svhn", "cifar10", "cifar100"), "--tensor_cache is for image datasets"
+        transform_train, transform_test = get_batch_transforms(args)
+        data, labels = dataset_tensors(full_train)
+        data, labels = data.to(device), labels.to(device)
+        train_inds, train_labeled_inds, valid_inds = [t.as_tensor(np.asarray(inds, dtype=np.int64), device=device)
+                                                      for inds in (train_inds, train_labeled_inds, valid_inds)]
+        dset_train = t.utils.data.TensorDataset(data[train_inds], labels[train_inds])
+        dset_train_labeled = t.utils.data.TensorDataset(data[train_labeled_inds], labels[train_labeled_inds])
+        dload_train = TensorLoader(dset_train.tensors, batch_size=args.ul_batch_size, transform=transform_train)
+        dload_train_vbnorm = TensorLoader(dset_train.tensors, batch_size=args.vbnorm_batch_size, shuffle=False,
+                                          transform=transform_train)
+        dload_train_labeled = TensorLoader(dset_train_labeled.tensors, batch_size=args.batch_size,
+                                           transform=transform_train)
+        dload_train_labeled_static = cycle(TensorLoader(dset_train_labeled.tensors, batch_size=args.batch_size,
+                                                        shuffle=False, transform=transform_train))
+        dload_valid = TensorLoader((data[valid_inds], labels[valid_inds]), batch_size=100, shuffle=False,
+                                   drop_last=False, transform=transform_test)
+        dload_test = TensorLoader(dataset_tensors(registry.raw(False)), batch_size=100, device=device,
+                                  shuffle=False, drop_last=False, transform=transform_test)
+        return dload_train, dload_train_labeled, dload_valid, dload_test, dset_train, dset_train_labeled, \
+               dload_train_labeled_static, dload_train_vbnorm
+
+    dset_train = registry.view(True, train_inds, transform_train)
+    dset_train_labeled = registry.view(True, train_labeled_inds, transform_train)
 
     if args.dataset in TOY_DSETS or args.dataset in REG_DSETS:
-        dset_train_labeled = dataset_fn(True, transform_train)[train_labeled_inds]
-        dload_train_labeled = FastLoader(dset_train_labeled,
-                                         batch_size=min(args.batch_size, len(
-                                             dset_train_labeled[0])))
+        # tensor datasets: keep them on the device and slice batches out of a per-epoch permutation
+        dload_train_labeled = TensorLoader(full_train[train_labeled_inds], batch_size=args.batch_size, device=device)
     else:
-        dset_train_labeled = DataSubset(
-            dataset_fn(True, transform_train),
-            inds=train_labeled_inds)
-        dload_train_labeled = DataLoader(dset_train_labeled, batch_size=min(args.batch_size, len(dset_train_labeled)), shuffle=True, num_workers=4, drop_last=True)
+        dload_train_labeled = make_loader(dset_train_labeled, batch_size=min(args.batch_size, len(dset_train_labeled)), shuffle=True, drop_last=True, num_workers=args.num_workers, prefetch_factor=args.prefetch_factor)
         dload_train_labeled = cycle(dload_train_labeled)
 
-    dset_valid = DataSubset(
-        dataset_fn(True, transform_test),
-        inds=valid_inds)
-    dload_train = DataLoader(dset_train, batch_size=args.ul_batch_size, shuffle=True, num_workers=4, drop_last=True)
-    dload_train_vbnorm = DataLoader(dset_train, batch_size=args.vbnorm_batch_size, shuffle=False, num_workers=4, drop_last=True)
-
+    dset_valid = registry.view(True, valid_inds, transform_test)
+    if args.dataset in REG_DSETS and args.stream_tabular:
+        # read the unlabeled table chunk by chunk instead of holding it on the device
+        exclude = np.setdiff1d(np.arange(len(full_train)), train_inds)
+        dload_train = regression_datasets.TabularLoader(full_train, args.ul_batch_size, exclude=exclude)
+    elif args.dataset in TOY_DSETS or args.dataset in REG_DSETS:
+        dload_train = TensorLoader(full_train[train_inds], batch_size=args.ul_batch_size, device=device)
+    else:
+        dload_train = make_loader(dset_train, batch_size=args.ul_batch_size, shuffle=True, drop_last=True, num_workers=args.num_workers, prefetch_factor=args.prefetch_factor)
+    dload_train_vbnorm = make_loader(dset_train, batch_size=args.vbnorm_batch_size, shuffle=False, drop_last=True, num_workers=args.num_workers, prefetch_factor=args.prefetch_factor)
 
-    dset_train_labeled = DataSubset(
-        dataset_fn(True, transform_train),
-        inds=train_labeled_inds)
-    dload_train_labeled_static = DataLoader(dset_train_labeled, batch_size=min(args.batch_size, len(dset_train_labeled)), shuffle=False, num_workers=4, drop_last=True)
+    dload_train_labeled_static = make_loader(dset_train_labeled, batch_size=min(args.batch_size, len(dset_train_labeled)), shuffle=False, drop_last=True, num_workers=args.num_workers, prefetch_factor=args.prefetch_factor)
     dload_train_labeled_static = cycle(dload_train_labeled_static)
-    dset_test = dataset_fn(False, transform_test)
-    dload_valid = DataLoader(dset_valid, batch_size=100, shuffle=False, num_workers=4, drop_last=False)
-    dload_test = DataLoader(dset_test, batch_size=100, shuffle=False, num_workers=4, drop_last=False)
+    dset_test = registry.view(False, transform=transform_test)
+    if args.dataset in REG_DSETS and args.stream_tabular:
+        valid_stream = full_train.subset(full_train.rows[np.sort(np.asarray(valid_inds, dtype=np.int64))])
+        dload_valid = regression_datasets.TabularLoader(valid_stream, 100, shuffle=False, drop_last=False)
+        dload_test = regression_datasets.TabularLoader(registry.raw(False), 100, shuffle=False, drop_last=False)
+    else:
+        dload_valid = make_loader(dset_valid, batch_size=100, shuffle=False, drop_last=False, num_workers=args.num_workers, prefetch_factor=args.prefetch_factor)
+        dload_test = make_loader(dset_test, batch_size=100, shuffle=False, drop_last=False, num_workers=args.num_workers, prefetch_factor=args.prefetch_factor)
     return dload_train, dload_train_labeled, dload_valid,dload_test, dset_train, dset_train_labeled, dload_train_labeled_static, dload_train_vbnorm
 
 
 def get_sample_q(args, device):
+    sgld_update = sgld.get_sgld_update(args.compile_sgld)
+    energy_priority = args.buffer_priority == "energy"
+    # keep fp16 input gradients of the SGLD energy out of the subnormal range (initial scale of
+    # each chain, backed off on overflow)
+    grad_scale = 1024. if args.amp == "fp16" else 1.
+
     def sample_p_0(replay_buffer, bs, y=None, momentum_buffer=None, data=None):
         if len(replay_buffer) == 0:
-            return init_random(args, bs), []
-        buffer_size = len(replay_buffer) if y is None else len(replay_buffer) // args.n_classes
-        inds = t.randint(0, buffer_size, (bs,))
-        # if cond, convert inds to class conditional inds
+            return init_random(args, bs, device), []
         if y is not None:
-            inds = y.cpu() * buffer_size + inds
             assert not args.uncond, "Can't drawn conditional samples without giving me y"
-        buffer_samples = replay_buffer[inds]
-        random_samples = init_random(args, bs)
-        if (args.dataset == "moons" or args.dataset == "rings") or args.dataset in REG_DSETS:
-            choose_random = (t.rand(bs) < args.reinit_freq).float()[:, None]
-        else:
-            choose_random = (t.rand(bs) < args.reinit_freq).float()[:, None, None, None]
         if args.buffer_reinit_from_data:
             assert data is not None
-            samples = choose_random * data.cpu() + (1 - choose_random) * buffer_samples
         else:
-            samples = choose_random * random_samples + (1 - choose_random) * buffer_samples
+            data = None
+        samples, inds, reinit_inds = replay_buffer.sample(bs, y=y, data=data)
         if momentum_buffer is not None:
-            momentum_buffer[inds] *= (1-choose_random) # Reset momentum to 0 when resetting data, keep as before if choosing buffer sample
+            momentum_buffer[inds[reinit_inds.to(inds.device)]] = 0. # Reset momentum to 0 when resetting data, keep as before if choosing buffer sample
         return samples.to(device), inds
 
     def sample_q(f, replay_buffer, y=None, n_steps=args.n_steps, seed_batch=None,
-                 optim_sgld=None, momentum_buffer=None, data=None):
+                 optim_sgld=None, momentum_buffer=None, data=None, bs=None):
         """this func takes in replay_buffer now so we have the option to sample from
         scratch (i.e. replay_buffer==[]).  See test_wrn_ebm.py for example.
         """
-        f.eval()
         # get batch size
-        bs = args.ul_batch_size if y is None else y.size(0)
+        if bs is None:
+            bs = args.ul_batch_size if y is None else y.size(0)
         # generate initial samples and buffer inds of those samples (if buffer is used)
         if seed_batch is not None:
             init_sample, buffer_inds = seed_batch, []
         else:
             init_sample, buffer_inds = sample_p_0(replay_buffer, bs=bs, y=y,
                                                   momentum_buffer=momentum_buffer, data=data)
-        x_k = t.autograd.Variable(init_sample, requires_grad=True)
         # sgld
+        momentum = None
         if momentum_buffer is not None:
-            momentum = momentum_buffer[buffer_inds].to(device)
-        for k in range(n_steps):
-            f_prime = t.autograd.grad(f(x_k, y=y).sum(), [x_k], retain_graph=True)[0]
-            if momentum_buffer is not None:
-                # Modification to usual momentum to "conserve energy" which should help for sampling
-                momentum = (args.sgld_momentum * momentum + (1-args.sgld_momentum) * f_prime)
-                x_k.data += args.sgld_lr * momentum
-            else:
-                x_k.data += args.sgld_lr * f_prime
-                x_k.data += args.sgld_std * t.randn_like(x_k)
+            momentum = momentum_buffer[buffer_inds.to(momentum_buffer.device)].to(device)
+        with sgld.sampling_mode(f):
+            x_k, energy = sgld.sgld_chain(lambda x: f(x, y=y), init_sample, n_steps, args.sgld_lr, args.sgld_std,
+                                          momentum=momentum, sgld_momentum=args.sgld_momentum,
+                                          update_fn=sgld_update, return_energy=True, grad_scale=grad_scale)
 
-        f.train()
         if args.optim_sgld:
-            final_samples = replay_buffer[buffer_inds].to(device).detach()
+            final_samples = replay_buffer.read(buffer_inds).to(device).detach()
         else:
-            final_samples = x_k.detach()
+            final_samples = x_k
         if momentum_buffer is not None:
-            momentum_buffer[buffer_inds] = momentum.cpu()
+            momentum_buffer[buffer_inds.to(momentum_buffer.device)] = momentum.to(momentum_buffer.device)
 
         # update replay buffer
         if seed_batch is None:
             # Only update replay buffer in PCD (CD = use seed batch at data)
             # Just detaching functionality for now
             if len(replay_buffer) > 0:
-                if args.optim_sgld:
-                    replay_buffer[buffer_inds].data = final_samples.cpu()
+                if energy_priority:
+                    replay_buffer.write(buffer_inds, final_samples, energy=energy)
                 else:
-                    replay_buffer[buffer_inds] = final_samples.cpu()
+                    replay_buffer.write(buffer_inds, final_samples)
         return final_samples
 
-    return sample_q
+    def sample_q_joint(f, replay_buffer, y, y_q=None, n_steps=args.n_steps, seed_batch=None,
+                       optim_sgld=None, momentum_buffer=None, data=None, bs=None):
+        """Draws the p(x) negatives (class-conditional on y_q if given) and the p(x, y) negatives
+        for labels y as one batch of chains, so each SGLD step is a single classify call whose
+        logits give logsumexp energies for the first rows and gathered energies for the rest.
+        Returns (x_q, x_q_lab) like two calls to sample_q would.
+        """
+        if y_q is not None:
+            bs = y_q.size(0)
+        elif bs is None:
+            bs = args.ul_batch_size
+        if seed_batch is not None:
+            init_sample, buffer_inds = t.cat([seed_batch, seed_batch]), []
+            bs = seed_batch.size(0)
+        else:
+            init_q, inds_q = sample_p_0(replay_buffer, bs=bs, y=y_q, momentum_buffer=momentum_buffer, data=data)
+            init_lab, inds_lab = sample_p_0(replay_buffer, bs=y.size(0), y=y, momentum_buffer=momentum_buffer,
+                                            data=data)
+            init_sample = t.cat([init_q, init_lab])
+            buffer_inds = t.cat([inds_q, inds_lab]) if len(replay_buffer) > 0 else []
+        # -1 marks unconditional chains
+        y_all = t.cat([t.full((bs,), -1, dtype=t.long, device=device) if y_q is None else y_q, y])
+
+        def energy_fn(x):
+            logits = f.classify(x)
+            return t.where(y_all >= 0, logits.gather(1, y_all.clamp(min=0)[:, None]).squeeze(1),
+                           logits.logsumexp(1))
+
+        momentum = None
+        if momentum_buffer is not None:
+            momentum = momentum_buffer[buffer_inds.to(momentum_buffer.device)].to(device)
+        with sgld.sampling_mode(f):
+            x_k, energy = sgld.sgld_chain(energy_fn, init_sample, n_steps, args.sgld_lr, args.sgld_std,
+                                          momentum=momentum, sgld_momentum=args.sgld_momentum,
+                                          update_fn=sgld_update, return_energy=True, grad_scale=grad_scale)
+
+        if args.optim_sgld:
+            final_samples = replay_buffer.read(buffer_inds).to(device).detach()
+        else:
+            final_samples = x_k
+        if momentum_buffer is not None:
+            momentum_buffer[buffer_inds.to(momentum_buffer.device)] = momentum.to(momentum_buffer.device)
+
+        if seed_batch is None and len(replay_buffer) > 0:
+            if energy_priority:
+                replay_buffer.write(buffer_inds, final_samples, energy=energy)
+            else:
+                replay_buffer.write(buffer_inds, final_samples)
+        return final_samples[:bs], final_samples[bs:]
+
+    return sample_q, sample_q_joint
 
 
 def eval_classification(f, dload, device):
@@ -688,14 +1006,46 @@ def eval_classification(f, dload, device):
 
 
 def checkpoint(f, buffer, tag, args, device):
+    # in distributed runs every rank has to call this: the buffer shards are either gathered
+    # into rank 0's checkpoint or, with --ckpt_buffer_shards, saved by each rank next to it
+    buffer_labels = buffer.labels if buffer.n_classes is not None else None
+    if args.ckpt_buffer_shards:
+        shard_names = ["{}.buffer{}".format(tag, rank) for rank in range(args.world_size)]
+        shard_dict = {"replay_buffer": buffer.checkpoint_state()}
+        if buffer_labels is not None:
+            shard_dict["replay_buffer_labels"] = buffer_labels.cpu()
+        t.save(shard_dict, os.path.join(args.save_dir, shard_names[args.rank]))
+        # the checkpoint must not refer to shards that aren't written yet
+        dist_utils.barrier()
+    else:
+        buffer_state = dist_utils.gather_shards(buffer.checkpoint_state())
+        if buffer_labels is not None:
+            buffer_labels = dist_utils.gather_shards(buffer_labels)
+    if args.rank != 0:
+        return
     f.cpu()
-    ckpt_dict = {
-        "model_state_dict": f.state_dict(),
-        "replay_buffer": buffer
-    }
+    ckpt_dict = {"model_state_dict": f.state_dict()}
+    if args.ckpt_buffer_shards:
+        ckpt_dict["replay_buffer_shards"] = shard_names
+    else:
+        ckpt_dict["replay_buffer"] = buffer_state
+        if buffer_labels is not None:
+            ckpt_dict["replay_buffer_labels"] = buffer_labels.cpu()
     t.save(ckpt_dict, os.path.join(args.save_dir, tag))
     f.to(device)
 
+
+def relabel_buffer(f, replay_buffer, device, batch_size=1000):
+    """Reassigns every replay buffer row to the class f predicts for it, so class-conditional
+    draws follow the model rather than the initial fixed class layout."""
+    labels = []
+    with t.no_grad(), sgld.sampling_mode(f):
+        for i in range(0, len(replay_buffer), batch_size):
+            inds = t.arange(i, min(i + batch_size, len(replay_buffer)), device=replay_buffer.device)
+            x = replay_buffer.read(inds).to(device)
+            labels.append(f.classify(x).view(x.size(0), -1).argmax(1))
+    replay_buffer.relabel(t.cat(labels))
+
 def plot_jacobian_spectrum(x_samples, f, epoch, use_penult=False):
     for c in range(args.n_classes):
         x_example = x_samples[c]
@@ -755,15 +1105,21 @@ def visualize_decision_boundary(net, Xf, Xfl, device, fname="data.png"):
 
 def main(args):
 
-    utils.makedirs(args.save_dir)
-    with open(f'{args.save_dir}/params.txt', 'w') as f:
-        json.dump(args.__dict__, f)
-    if args.print_to_log:
-        sys.stdout = open(f'{args.save_dir}/log.txt', 'w')
+    device = dist_utils.init_distributed(args)
+    if args.rank == 0:
+        utils.makedirs(args.save_dir)
+        with open(f'{args.save_dir}/params.txt', 'w') as f:
+            json.dump(args.__dict__, f)
+        if args.print_to_log:
+            sys.stdout = open(f'{args.save_dir}/log.txt', 'w')
+    else:
+        # only rank 0 logs
+        sys.stdout = open(os.devnull, 'w')
 
-    t.manual_seed(args.t_seed)
+    # ranks draw different chains and noise; the model itself is synced from rank 0 below
+    t.manual_seed(args.t_seed + args.rank)
     if t.cuda.is_available():
-        t.cuda.manual_seed_all(args.t_seed)
+        t.cuda.manual_seed_all(args.t_seed + args.rank)
 
     if args.dataset == "mnist":
         args.n_ch = 1
@@ -780,24 +1136,28 @@ def main(args):
 
     # datasets
     dload_train, dload_train_labeled, dload_valid, dload_test, dset_train, \
-    dset_train_labeled, dload_train_labeled_static, dload_train_vbnorm = get_data(args)
-
-    device = t.device('cuda' if t.cuda.is_available() else 'cpu')
+    dset_train_labeled, dload_train_labeled_static, dload_train_vbnorm = get_data(args, device)
 
     ref_x = None
     if args.vbnorm:
         ref_x = next(iter(dload_train_vbnorm))[0].to(device)
 
-    sample_q = get_sample_q(args, device)
+    sample_q, sample_q_joint = get_sample_q(args, device)
 
     momentum_buffer = None
     if args.use_sgld_momentum:
         f, replay_buffer, momentum_buffer = get_model_and_buffer_with_momentum(args, device, ref_x)
     else:
         f, replay_buffer = get_model_and_buffer(args, device, ref_x)
+    dist_utils.broadcast_module(f)
 
     sqrt = lambda x: int(t.sqrt(t.Tensor([x])))
-    plot = lambda p, x: tv.utils.save_image(t.clamp(x, -1, 1), p, normalize=True, nrow=sqrt(x.size(0)))
+    logit_transform = get_logit_transform(args)
+    if logit_transform is not None:
+        # map logit-space samples back to pixels instead of min-max normalizing them
+        plot = lambda p, x: tv.utils.save_image(logit_transform.inverse(x), p, normalize=False, nrow=sqrt(x.size(0)))
+    else:
+        plot = lambda p, x: tv.utils.save_image(t.clamp(x, -1, 1), p, normalize=True, nrow=sqrt(x.size(0)))
 
 
     # optimizer
@@ -807,10 +1167,22 @@ def main(args):
     else:
         optim = t.optim.SGD(params, lr=args.lr, momentum=.9, weight_decay=args.weight_decay)
 
+    if args.compile_model:
+        f = compile_model(f)
+    if args.amp != "none":
+        assert args.amp == "bf16" or device.type == "cuda", "fp16 autocast needs a GPU, use --amp bf16 on CPU"
+        f = autocast_model(f, device, args.amp)
+    # loss scaling is only needed (and only enabled) for fp16
+    scaler = make_grad_scaler(args.amp)
+
     optim_sgld = None
     if args.optim_sgld:
         # This SGD optimizer is basically SGLD with 0 noise
-        optim_sgld = t.optim.SGD([replay_buffer], lr=args.sgld_lr, momentum=args.optim_sgld_momentum)
+        optim_sgld = t.optim.SGD([replay_buffer.buffer], lr=args.sgld_lr, momentum=args.optim_sgld_momentum)
+
+    chain_exchange = None
+    if args.world_size > 1 and args.buffer_exchange_every > 0:
+        chain_exchange = dist_utils.ChainExchange(args.buffer_exchange_frac, momentum_buffer=momentum_buffer)
 
 
     best_valid_acc = 0.0
@@ -845,14 +1217,17 @@ def main(args):
             print("Decaying lr to {}".format(new_lr))
 
 
-        for i, (x_p_d, _) in tqdm(enumerate(dload_train)):
+        train_batches = paired_batches(dload_train, dload_train_labeled)
+        if args.prefetch:
+            # copy the next batches to the device while this iteration runs
+            train_batches = DevicePrefetcher(train_batches, device)
+        for i, (x_p_d, _, x_lab, y_lab) in tqdm(enumerate(train_batches)):
             if cur_iter <= args.warmup_iters:
                 lr = args.lr * cur_iter / float(args.warmup_iters)
                 for param_group in optim.param_groups:
                     param_group['lr'] = lr
 
             x_p_d = x_p_d.to(device)
-            x_lab, y_lab = dload_train_labeled.__next__()
             x_lab, y_lab = x_lab.to(device), y_lab.to(device)
 
             seed_batch = None
@@ -864,7 +1239,7 @@ def main(args):
             if args.vat:
 
                 if args.eval_mode_except_clf:
-                    f.train()
+                    sgld.set_stats_frozen(f, False)
 
                 optim.zero_grad()
                 vat_loss = VATLoss(xi=10.0, eps=args.vat_eps, ip=1)
@@ -880,11 +1255,13 @@ def main(args):
                     loss += cond_entropy(logits_unlab) * args.ent_min_weight
 
 
-                loss.backward()
-                optim.step()
+                scaler.scale(loss).backward()
+                dist_utils.all_reduce_grads(f)
+                scaler.step(optim)
+                scaler.update()
 
                 if args.eval_mode_except_clf:
-                    f.eval()
+                    sgld.set_stats_frozen(f, True)
 
                 cur_iter += 1
 
@@ -897,128 +1274,201 @@ def main(args):
                             loss.item(),
                             acc.item()))
 
-                if args.svd_jacobian and cur_iter % args.svd_every == 0:
+                if args.svd_jacobian and cur_iter % args.svd_every == 0 and args.rank == 0:
                     plot_jacobian_spectrum(static_samples, f, epoch)
                     plot_jacobian_spectrum(static_samples, f, epoch,
                                            use_penult=True)
 
             else:
 
-                if args.p_x_weight > 0:  # maximize log p(x)
-                    if args.score_match:
-                        sm_loss = sliced_score_matching(f, x_p_d, args.n_sm_vectors)
-                        L += args.p_x_weight * sm_loss
-                        if cur_iter % args.print_every == 0:
-                            print('sm_loss {}:{:>d} = {:>14.9f}'.format(
-                                    epoch, i, sm_loss))
-                    elif args.denoising_score_match:
-                        # Multiply by args.denoising_sm_sigma**2 to keep scale of loss
-                        # constant across sigma changes
-                        # See 4.2 in Generative Modeling by Estimating Gradients of the
-                        # Data Distribution (Yang, Ermon 2019)
-                        sm_loss = args.denoising_sm_sigma**2 * denoising_score_matching(f, x_p_d,
-                                                        args.denoising_sm_sigma)
-                        L += args.p_x_weight * sm_loss
-                        if cur_iter % args.print_every == 0:
-                            print('sm_loss {}:{:>d} = {:>14.9f}'.format(
-                                epoch, i, sm_loss))
-
-                    else:
-                        # else:
+                optim.zero_grad()
+                # with --micro_batches the step's batches and their SGLD chains are processed in
+                # slices whose gradients are accumulated, so peak memory follows the slice size
+                batch = (x_p_d, x_lab, y_lab, seed_batch)
+                for mb, (x_p_d, x_lab, y_lab, seed_batch) in enumerate(micro_batches(batch, args.micro_batches)):
+                    L = 0.
+                    print_now = cur_iter % args.print_every == 0 and mb == 0
+
+                    x_q = x_q_lab = None
+                    if args.joint_sgld and args.p_x_weight > 0 and args.p_x_y_weight > 0 \
+                            and not (args.score_match or args.denoising_score_match):
+                        # one batch of chains for both objectives instead of two sequential sample_q calls
+                        assert not args.uncond, "joint sampling needs a class-conditional EBM"
+                        y_q = None
                         if args.class_cond_p_x_sample:
-                            assert not args.uncond, "can only draw class-conditional samples if EBM is class-cond"
-                            y_q = t.randint(0, args.n_classes, (args.batch_size,)).to(device)
-                            x_q = sample_q(f, replay_buffer, y=y_q, optim_sgld=optim_sgld,
-                                           seed_batch=seed_batch, momentum_buffer=momentum_buffer, data=x_p_d)
+                            y_q = t.randint(0, args.n_classes, (args.batch_size // args.micro_batches,)).to(device)
+                        x_q, x_q_lab = sample_q_joint(f, replay_buffer, y_lab, y_q=y_q, optim_sgld=optim_sgld,
+                                                      seed_batch=seed_batch, momentum_buffer=momentum_buffer,
+                                                      data=x_p_d, bs=x_p_d.size(0))
+
+                    joint = None
+                    if args.joint_forward and not (args.score_match or args.denoising_score_match):
+                        # draw all negatives first, then push every batch of the step through one backbone pass
+                        assert not args.uncond, "the joint forward pass needs a class-conditional EBM"
+                        if args.p_x_weight > 0 and x_q is None:
+                            y_q = None
+                            if args.class_cond_p_x_sample:
+                                y_q = t.randint(0, args.n_classes, (args.batch_size // args.micro_batches,)).to(device)
+                            x_q = sample_q(f, replay_buffer, y=y_q, optim_sgld=optim_sgld, seed_batch=seed_batch,
+                                           momentum_buffer=momentum_buffer, data=x_p_d, bs=x_p_d.size(0))
+                        if args.p_x_y_weight > 0 and x_q_lab is None:
+                            x_q_lab = sample_q(f, replay_buffer, y=y_lab, optim_sgld=optim_sgld,
+                                               seed_batch=seed_batch, momentum_buffer=momentum_buffer, data=x_p_d)
+                        # with --eval_mode_except_clf the classifier terms run with live norm statistics
+                        clf_mode = True if args.eval_mode_except_clf else None
+                        xy_mode = clf_mode if args.p_y_given_x_weight > 0 else None
+                        joint = JointForward(f)
+                        if args.p_x_weight > 0:
+                            k_p, k_q = joint.add(x_p_d), joint.add(x_q)
+                        if args.p_y_given_x_weight > 0:
+                            k_lab = joint.add(x_lab, clf_mode)
+                            if args.ent_min:
+                                k_unlab = joint.add(x_p_d, clf_mode)
+                        if args.p_x_y_weight > 0:
+                            k_xy, k_q_lab = joint.add(x_lab, xy_mode), joint.add(x_q_lab, xy_mode)
+                        joint.run()
+
+                    if args.p_x_weight > 0:  # maximize log p(x)
+                        if args.score_match:
+                            sm_loss = sliced_score_matching(f, x_p_d, args.n_sm_vectors)
+                            L += args.p_x_weight * sm_loss
+                            if print_now:
+                                print('sm_loss {}:{:>d} = {:>14.9f}'.format(
+                                        epoch, i, sm_loss))
+                        elif args.denoising_score_match:
+                            # Multiply by args.denoising_sm_sigma**2 to keep scale of loss
+                            # constant across sigma changes
+                            # See 4.2 in Generative Modeling by Estimating Gradients of the
+                            # Data Distribution (Yang, Ermon 2019)
+                            sm_loss = args.denoising_sm_sigma**2 * denoising_score_matching(f, x_p_d,
+                                                            args.denoising_sm_sigma)
+                            L += args.p_x_weight * sm_loss
+                            if print_now:
+                                print('sm_loss {}:{:>d} = {:>14.9f}'.format(
+                                    epoch, i, sm_loss))
 
                         else:
-                            x_q = sample_q(f, replay_buffer, optim_sgld=optim_sgld,
-                                           seed_batch=seed_batch, momentum_buffer=momentum_buffer, data=x_p_d)  # sample from log-sumexp
-
-                        fp_all = f(x_p_d)
-                        fq_all = f(x_q)
-                        fp = fp_all.mean()
-                        fq = fq_all.mean()
-
-                        l_p_x = -(fp - fq)
-                        if cur_iter % args.print_every == 0:
-                            print('P(x) | {}:{:>d} f(x_p_d)={:>14.9f} f(x_q)={:>14.9f} d={:>14.9f}'.format(epoch, i, fp, fq,
-                                                                                                           fp - fq))
-                        L += args.p_x_weight * l_p_x
-
-                        if args.l2_energy_reg > 0:
-                            L += args.l2_energy_reg * (fp_all ** 2).sum()
-                            # If we want to regularize the negative samples as https://arxiv.org/pdf/1903.08689.pdf does too
-                            if args.l2_energy_reg_neg:
-                                L += args.l2_energy_reg * (fq_all ** 2).sum()
-
-
-                if args.p_y_given_x_weight > 0:  # maximize log p(y | x)
-                    if args.eval_mode_except_clf:
-                        f.train()
-
-                    logits = f.classify(x_lab)
-                    l_p_y_given_x = nn.CrossEntropyLoss()(logits, y_lab)
-
-                    if cur_iter % args.print_every == 0:
-                        acc = (logits.max(1)[1] == y_lab).float().mean()
-                        print('P(y|x) {}:{:>d} loss={:>14.9f}, acc={:>14.9f}'.format(epoch,
-                                                                                     cur_iter,
-                                                                                     l_p_y_given_x.item(),
-                                                                                     acc.item()))
-
-                    if args.svd_jacobian and cur_iter % args.svd_every == 0:
-                        plot_jacobian_spectrum(static_samples, f, epoch)
-                        plot_jacobian_spectrum(static_samples, f, epoch,
-                                               use_penult=True)
-
-                    L += args.p_y_given_x_weight * l_p_y_given_x
-
-                    if args.ent_min:
-                        # L += cond_entropy(logits) * args.ent_min_weight
-                        logits_unlab = f.classify(x_p_d)
-                        # Just unlabeled now
-                        L += cond_entropy(logits_unlab) * args.ent_min_weight
-
-                if args.p_x_y_weight > 0:  # maximize log p(x, y)
-                    assert not args.uncond, "this objective can only be trained for class-conditional EBM DUUUUUUUUHHHH!!!"
-                    x_q_lab = sample_q(f, replay_buffer, y=y_lab, optim_sgld=optim_sgld,
-                                       seed_batch=seed_batch, momentum_buffer=momentum_buffer, data=x_p_d)
-                    fp, fq = f(x_lab, y_lab).mean(), f(x_q_lab, y_lab).mean()
-                    l_p_x_y = -(fp - fq)
-                    if cur_iter % args.print_every == 0:
-                        print('P(x, y) | {}:{:>d} f(x_p_d)={:>14.9f} f(x_q)={:>14.9f} d={:>14.9f}'.format(epoch, i, fp, fq,
-                                                                                                          fp - fq))
-
-                    L += args.p_x_y_weight * l_p_x_y
-
-                if args.vat_also:
-                    vat_loss = VATLoss(xi=10.0, eps=args.vat_eps, ip=1)
-                    lds = vat_loss(f, x_p_d)
-                    L += args.vat_also_weight * lds
-
-                if args.class_cond_label_prop and cur_iter > args.warmup_iters:
-
-                    lds_loss = LDSLoss(n_steps=args.label_prop_n_steps)
-                    lds = lds_loss(f, x_p_d, sample_q, seed_batch=x_p_d)
-
-                    L += args.label_prop_weight * lds
-
-                # break if the loss diverged...easier for poppa to run experiments this way
-                if L.abs().item() > 1e8:
-                    print("BAD BOIIIIIIIIII")
-                    1/0
+                            # else:
+                            if x_q is not None:
+                                pass # already drawn jointly with the p(x, y) negatives
+                            elif args.class_cond_p_x_sample:
+                                assert not args.uncond, "can only draw class-conditional samples if EBM is class-cond"
+                                y_q = t.randint(0, args.n_classes, (args.batch_size // args.micro_batches,)).to(device)
+                                x_q = sample_q(f, replay_buffer, y=y_q, optim_sgld=optim_sgld,
+                                               seed_batch=seed_batch, momentum_buffer=momentum_buffer, data=x_p_d)
+
+                            else:
+                                x_q = sample_q(f, replay_buffer, optim_sgld=optim_sgld, seed_batch=seed_batch,
+                                               momentum_buffer=momentum_buffer, data=x_p_d,
+                                               bs=x_p_d.size(0))  # sample from log-sumexp
+
+                            if joint is not None:
+                                fp_all, fq_all = joint.energy(k_p), joint.energy(k_q)
+                            else:
+                                fp_all = f(x_p_d)
+                                fq_all = f(x_q)
+                            fp = fp_all.mean()
+                            fq = fq_all.mean()
+                            if args.buffer_priority == "energy":
+                                replay_buffer.energy_ref = fp.detach()
+
+                            l_p_x = -(fp - fq)
+                            if print_now:
+                                print('P(x) | {}:{:>d} f(x_p_d)={:>14.9f} f(x_q)={:>14.9f} d={:>14.9f}'.format(epoch, i, fp, fq,
+                                                                                                               fp - fq))
+                            L += args.p_x_weight * l_p_x
+
+                            if args.l2_energy_reg > 0:
+                                # summed, not averaged, over the slice: scaled by the number of slices
+                                # so it is not divided by it with the rest of L below
+                                L += args.micro_batches * args.l2_energy_reg * (fp_all ** 2).sum()
+                                # If we want to regularize the negative samples as https://arxiv.org/pdf/1903.08689.pdf does too
+                                if args.l2_energy_reg_neg:
+                                    L += args.micro_batches * args.l2_energy_reg * (fq_all ** 2).sum()
+
+
+                    if args.p_y_given_x_weight > 0:  # maximize log p(y | x)
+                        if args.eval_mode_except_clf:
+                            sgld.set_stats_frozen(f, False)
+
+                        logits = joint.classify(k_lab) if joint is not None else f.classify(x_lab)
+                        l_p_y_given_x = nn.CrossEntropyLoss()(logits, y_lab)
+
+                        if print_now:
+                            acc = (logits.max(1)[1] == y_lab).float().mean()
+                            print('P(y|x) {}:{:>d} loss={:>14.9f}, acc={:>14.9f}'.format(epoch,
+                                                                                         cur_iter,
+                                                                                         l_p_y_given_x.item(),
+                                                                                         acc.item()))
+
+                        if args.svd_jacobian and cur_iter % args.svd_every == 0 and args.rank == 0 and mb == 0:
+                            plot_jacobian_spectrum(static_samples, f, epoch)
+                            plot_jacobian_spectrum(static_samples, f, epoch,
+                                                   use_penult=True)
+
+                        L += args.p_y_given_x_weight * l_p_y_given_x
+
+                        if args.ent_min:
+                            # L += cond_entropy(logits) * args.ent_min_weight
+                            logits_unlab = joint.classify(k_unlab) if joint is not None else f.classify(x_p_d)
+                            # Just unlabeled now
+                            L += cond_entropy(logits_unlab) * args.ent_min_weight
+
+                    if args.p_x_y_weight > 0:  # maximize log p(x, y)
+                        assert not args.uncond, "this objective can only be trained for class-conditional EBM DUUUUUUUUHHHH!!!"
+                        if x_q_lab is None:
+                            x_q_lab = sample_q(f, replay_buffer, y=y_lab, optim_sgld=optim_sgld,
+                                               seed_batch=seed_batch, momentum_buffer=momentum_buffer, data=x_p_d)
+                        if joint is not None:
+                            fp, fq = joint.energy(k_xy, y_lab).mean(), joint.energy(k_q_lab, y_lab).mean()
+                        else:
+                            fp, fq = f(x_lab, y_lab).mean(), f(x_q_lab, y_lab).mean()
+                        l_p_x_y = -(fp - fq)
+                        if print_now:
+                            print('P(x, y) | {}:{:>d} f(x_p_d)={:>14.9f} f(x_q)={:>14.9f} d={:>14.9f}'.format(epoch, i, fp, fq,
+                                                                                                              fp - fq))
 
-                optim.zero_grad()
-                L.backward()
-                optim.step()
+                        L += args.p_x_y_weight * l_p_x_y
+
+                    if args.vat_also:
+                        vat_loss = VATLoss(xi=10.0, eps=args.vat_eps, ip=1)
+                        lds = vat_loss(f, x_p_d)
+                        L += args.vat_also_weight * lds
+
+                    if args.class_cond_label_prop and cur_iter > args.warmup_iters:
+
+                        lds_loss = LDSLoss(n_steps=args.label_prop_n_steps)
+                        lds = lds_loss(f, x_p_d, sample_q, seed_batch=x_p_d)
+
+                        L += args.label_prop_weight * lds
+
+                    # break if the loss diverged...easier for poppa to run experiments this way
+                    if L.abs().item() > 1e8:
+                        print("BAD BOIIIIIIIIII")
+                        1/0
+
+                    scaler.scale(L / args.micro_batches).backward()
+                x_p_d, x_lab, y_lab, seed_batch = batch
+                dist_utils.all_reduce_grads(f)
+                scaler.step(optim)
+                scaler.update()
 
                 if args.eval_mode_except_clf:
-                    f.eval()
+                    sgld.set_stats_frozen(f, True)
 
                 cur_iter += 1
 
-                if cur_iter % args.viz_every == 0:
+                if chain_exchange is not None:
+                    # lands during the next step; chains are swapped in place of the ones sent away
+                    chain_exchange.finish(replay_buffer)
+                    if cur_iter % args.buffer_exchange_every == 0:
+                        chain_exchange.start(replay_buffer)
+
+                if args.buffer_relabel_every > 0 and cur_iter % args.buffer_relabel_every == 0:
+                    assert not args.uncond, "can only relabel the replay buffer if EBM is class-cond"
+                    relabel_buffer(f, replay_buffer, device)
+
+                if cur_iter % args.viz_every == 0 and args.rank == 0:
                     if args.plot_uncond:
                         if args.class_cond_p_x_sample:
                             assert not args.uncond, "can only draw class-conditional samples if EBM is class-cond"
@@ -1041,6 +1491,9 @@ def main(args):
                                          seed_batch=seed_batch, momentum_buffer=momentum_buffer, data=x_p_d)
                         plot('{}/x_q_y{}_{:>06d}.png'.format(args.save_dir, epoch, i), x_q_y)
 
+        if chain_exchange is not None:
+            chain_exchange.finish(replay_buffer)
+
         if epoch % args.ckpt_every == 0:
             checkpoint(f, replay_buffer, f'ckpt_{epoch}.pt', args, device)
 
@@ -1051,7 +1504,8 @@ def main(args):
                 best_valid_found = False
                 correct, loss = eval_classification(f, dload_valid, device)
                 print("Epoch {}: Valid Loss {}, Valid Acc {}".format(epoch, loss, correct))
-                if correct >= best_valid_acc:
+                # ranks see different eval noise, so rank 0 decides for everyone
+                if dist_utils.broadcast_object(correct >= best_valid_acc):
                     best_valid_acc = correct
                     print("Best Valid!: {}".format(correct))
                     best_valid_found = True
@@ -1061,9 +1515,10 @@ def main(args):
                 # test set
                 correct, loss = eval_classification(f, dload_test, device)
                 print("Epoch {}: Test Loss {}, Test Acc {}".format(epoch, loss, correct))
-            f.train()
+            if not args.eval_mode_except_clf:
+                f.train()
 
-            if (args.dataset == "moons" or args.dataset == "rings") and best_valid_found:
+            if (args.dataset == "moons" or args.dataset == "rings") and best_valid_found and args.rank == 0:
                 def vis(savefile, random_state=None):
                     plt.clf()
                     if args.dataset == "moons":
@@ -1092,16 +1547,31 @@ def main(args):
 
         checkpoint(f, replay_buffer, "last_ckpt.pt", args, device)
 
+    if args.export_model and args.rank == 0:
+        # standalone TorchScript model, loadable with eval_wrn_ebm.py / attack_model.py --scripted
+        export_model(f, init_random(args, 2, device), conditional=not args.uncond,
+                     path=os.path.join(args.save_dir, "model_export.pt"))
+
 
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser("Energy Based Models and Shit")
+    parser.add_argument("--num_workers", type=int, default=4, help="DataLoader worker processes (kept alive across epochs)")
+    parser.add_argument("--prefetch_factor", type=int, default=2, help="Batches each DataLoader worker loads ahead")
     #cifar
     parser.add_argument("--dataset", type=str, default="moons", choices=["cifar10", "svhn", "mnist",
                                                                          "cifar100", "moons", "rings",
                                                                          "concrete", "protein", "navy",
                                                                          "power_plant", "year"])
     parser.add_argument("--data_root", type=str, default="../data")
+    parser.add_argument("--prefetch", action="store_true",
+                        help="Move the next data and labeled batches to the device asynchronously")
+    parser.add_argument("--stream_tabular", action="store_true",
+                        help="Stream regression datasets (e.g. year) from a memory-mapped cache in shuffled "
+                             "blocks instead of loading them into memory")
+    parser.add_argument("--tensor_cache", action="store_true",
+                        help="Keep MNIST/SVHN/CIFAR as uint8 tensors on the device and augment whole batches "
+                             "there instead of per image in DataLoader workers")
     # optimization
     parser.add_argument("--lr", type=float, default=1e-4)
     parser.add_argument("--decay_epochs", nargs="+", type=int, default=[160, 180],
@@ -1122,6 +1592,12 @@ if __name__ == "__main__":
     parser.add_argument("--p_y_given_x_weight", type=float, default=1.)
     parser.add_argument("--label_prop_weight", type=float, default=1.)
     parser.add_argument("--p_x_y_weight", type=float, default=0.)
+    parser.add_argument("--joint_forward", action="store_true",
+                        help="Run the data, labeled, entropy-minimization and sampled batches of a training step "
+                             "through the backbone in one pass (norm statistics stay per batch)")
+    parser.add_argument("--joint_sgld", action="store_true",
+                        help="When both p(x) and p(x, y) are trained, run their SGLD chains as one batch "
+                             "(one classify call per step instead of two)")
     # regularization
     parser.add_argument("--dropout_rate", type=float, default=0.0)
     parser.add_argument("--sigma", type=float, default=3e-2,
@@ -1132,6 +1608,9 @@ if __name__ == "__main__":
     # network
     parser.add_argument("--norm", type=str, default=None, choices=[None, "norm", "batch", "instance", "layer", "act"],
                         help="norm to add to weights, none works fine")
+    parser.add_argument("--grad_checkpoint", action="store_true",
+                        help="Recompute the activations of each Wide_ResNet block / ConvLarge conv block in the "
+                             "backward (training and SGLD) instead of storing them")
     # EBM specific
     parser.add_argument("--n_steps", type=int, default=20,
                         help="number of steps of SGLD per iteration, 100 works for short-run, 20 works for PCD")
@@ -1143,8 +1622,49 @@ if __name__ == "__main__":
                              "Sample quality higher if set, but classification accuracy better if not.")
     parser.add_argument("--buffer_size", type=int, default=10000)
     parser.add_argument("--reinit_freq", type=float, default=.05)
+    parser.add_argument("--buffer_backend", type=str, default="device", choices=["device", "cpu", "pinned", "memmap"],
+                        help="Where the PCD replay buffer is stored. pinned keeps it in page-locked host "
+                             "memory and prefetches chains to the device asynchronously (for very large buffers). "
+                             "memmap stores it in save_dir/replay_buffer.npy and checkpoints only reference it (with an undo log "
+                             "of the rows written since, so the newest checkpoint always restores exactly)")
+    parser.add_argument("--buffer_relabel_every", type=int, default=0,
+                        help="Iterations between reassigning replay buffer rows to the class the model predicts "
+                             "for them (class sizes then follow the model); 0 keeps the initial equal class blocks")
+    parser.add_argument("--buffer_storage", type=str, default="float32", choices=["float32", "float16", "uint8"],
+                        help="Storage format of replay buffer samples. uint8 uses a per-sample affine "
+                             "quantization (see bench_replay_buffer.py for the quality/throughput tradeoff)")
+    parser.add_argument("--buffer_priority", type=str, default="none", choices=["none", "age", "energy"],
+                        help="Weight unconditional replay buffer draws by row age (stale chains first) or by the "
+                             "gap between a chain's energy and the data energy, via an O(log N) sum tree")
+    parser.add_argument("--buffer_priority_alpha", type=float, default=1.,
+                        help="Exponent on the energy gap for --buffer_priority energy")
+    parser.add_argument("--buffer_age_decay", type=float, default=1e-3,
+                        help="Priority grows as exp(decay * write-backs since a row was refreshed) for --buffer_priority age")
     parser.add_argument("--sgld_lr", type=float, default=1.0)
     parser.add_argument("--sgld_std", type=float, default=1e-2)
+    parser.add_argument("--amp", type=str, default="none", choices=["none", "bf16", "fp16"],
+                        help="Run the model (training losses and SGLD energies) under autocast; fp16 also "
+                             "scales the loss. SGLD updates and the replay buffer stay fp32")
+    parser.add_argument("--distributed", action="store_true",
+                        help="Data-parallel training over the processes started by torchrun: each rank samples "
+                             "from its own shard of the replay buffer and data, gradients are averaged")
+    parser.add_argument("--dist_backend", type=str, default=None, choices=["nccl", "gloo"],
+                        help="Process group backend for --distributed (default: nccl with GPUs, else gloo)")
+    parser.add_argument("--micro_batches", type=int, default=1,
+                        help="Split each step's data batches and SGLD chain batches into this many slices "
+                             "and accumulate their gradients, for large --ul_batch_size on limited memory")
+    parser.add_argument("--buffer_exchange_every", type=int, default=0,
+                        help="With --distributed, swap chains between the ranks' replay buffer shards every "
+                             "this many iterations (0 = never)")
+    parser.add_argument("--buffer_exchange_frac", type=float, default=.1,
+                        help="Fraction of each rank's chains sent to the next rank in an exchange")
+    parser.add_argument("--ckpt_buffer_shards", action="store_true",
+                        help="Each rank saves its replay buffer shard next to the checkpoint instead of "
+                             "gathering the whole buffer on rank 0")
+    parser.add_argument("--compile_sgld", action="store_true", help="Fuse the SGLD update with torch.compile (or TorchScript)")
+    parser.add_argument("--compile_model", action="store_true", help="Run the model's forward and classify through torch.compile")
+    parser.add_argument("--export_model", action="store_true",
+                        help="After training, save the model as a standalone TorchScript module (model_export.pt)")
     # logging + evaluation
     parser.add_argument("--save_dir", type=str, default='./experiment')
     parser.add_argument("--ckpt_every", type=int, default=10, help="Epochs between checkpoint save")
@@ -1192,7 +1712,9 @@ if __name__ == "__main__":
     parser.add_argument("--denoising_score_match", action="store_true", help="Use denoising score matching to train")
     parser.add_argument("--denoising_sm_sigma", type=float, default=0.1, help="Noise to add in denoising score matching")
     parser.add_argument("--leaky_relu", action="store_true", help="Use Leaky ReLU activation on NN instead of ReLU. Note CNN has leaky ReLU by default")
-    parser.add_argument("--eval_mode_except_clf", action="store_true", help="Pytorch eval mode on everything except classifier training")
+    parser.add_argument("--eval_mode_except_clf", action="store_true", help="Pytorch eval mode on everything except classifier training. "
+                        "The energy terms run with frozen norm statistics and dropout throughout training "
+                        "(sampling and epoch evaluation no longer switch the model back to train mode)")
     parser.add_argument("--use_cnn", action="store_true", help="Use CNN")
     parser.add_argument("--cnn_no_bn", action="store_true", help="No BN on CNN architecture")
     parser.add_argument("--cnn_no_dropout", action="store_true", help="No Dropout on CNN architecture")
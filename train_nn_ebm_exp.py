@@ -15,7 +15,7 @@
 
 import utils
 import torch as t, torch.nn as nn, torch.nn.functional as tnnF, torch.distributions as tdist
-from torch.utils.data import DataLoader, Dataset
+from torch.utils.data import DataLoader
 import torchvision as tv, torchvision.transforms as tr
 import os
 import sys
@@ -40,24 +40,11 @@ from losses import VATLoss, LDSLoss, sliced_score_matching_vr, \
     sliced_score_matching, denoising_score_matching
 
 import toy_data
+import sgld
+from data_registry import DatasetRegistry, get_split_inds, split_cache_path
 TOY_DSETS = ("moons", "circles", "8gaussians", "pinwheel", "2spirals", "checkerboard", "rings", "swissroll")
 
 
-class DataSubset(Dataset):
-    def __init__(self, base_dataset, inds=None, size=-1):
-        self.base_dataset = base_dataset
-        if inds is None:
-            inds = np.random.choice(list(range(len(base_dataset))), size, replace=False)
-        self.inds = inds
-
-    def __getitem__(self, index):
-        base_ind = self.inds[index]
-        return self.base_dataset[base_ind]
-
-    def __len__(self):
-        return len(self.inds)
-
-
 class Swish(nn.Module):
     def __init__(self, dim=-1):
         super(Swish, self).__init__()
@@ -380,6 +367,7 @@ def get_model_and_buffer(args, device, sample_q, ref_x=None):
         print(f"loading model from {args.load_path}")
         ckpt_dict = t.load(args.load_path)
         f.load_state_dict(ckpt_dict["model_state_dict"])
+        sgld.invalidate_layers(f)
         replay_buffer = ckpt_dict["replay_buffer"]
 
     f = f.to(device)
@@ -532,52 +520,36 @@ def get_data(args):
                                     split="train" if train else "test")
 
 
+    # raw splits are loaded once; every set below is an index view with its own transform
+    registry = DatasetRegistry(dataset_fn)
     # get all training inds
-    full_train = dataset_fn(True, transform_train)
-    all_inds = list(range(len(full_train)))
-    # set seed
-    np.random.seed(args.dataset_seed)
-    # shuffle
-    np.random.shuffle(all_inds)
-    # seperate out validation set
-    if args.n_valid is not None:
-        valid_inds, train_inds = all_inds[:args.n_valid], all_inds[args.n_valid:]
-    else:
-        valid_inds, train_inds = [], all_inds
-    train_inds = np.array(train_inds)
-    train_labeled_inds = []
-    other_inds = []
-
-    train_labels = np.array([full_train[ind][1] for ind in train_inds])
-    if args.labels_per_class > 0:
-        for i in range(args.n_classes):
-            train_labeled_inds.extend(train_inds[train_labels == i][:args.labels_per_class])
-            other_inds.extend(train_inds[train_labels == i][args.labels_per_class:])
-    else:
-        train_labeled_inds = train_inds
-
-    dset_train = DataSubset(
-        dataset_fn(True, transform_train),
-        inds=train_inds)
-    dset_train_labeled = DataSubset(
-        dataset_fn(True, transform_train),
-        inds=train_labeled_inds)
-    dset_valid = DataSubset(
-        dataset_fn(True, transform_test),
-        inds=valid_inds)
+    full_train = registry.raw(True)
+    split_cache = None
+    if args.dataset not in TOY_DSETS:
+        split_cache = split_cache_path(args.data_root, args.dataset, args.dataset_seed, args.n_valid,
+                                       args.labels_per_class)
+    train_inds, valid_inds, train_labeled_inds = get_split_inds(
+        full_train, args.dataset_seed, n_valid=args.n_valid, labels_per_class=args.labels_per_class,
+        n_classes=args.n_classes, cache_path=split_cache)
+
+    dset_train = registry.view(True, train_inds, transform_train)
+    dset_train_labeled = registry.view(True, train_labeled_inds, transform_train)
+    dset_valid = registry.view(True, valid_inds, transform_test)
     dload_train = DataLoader(dset_train, batch_size=args.batch_size, shuffle=True, num_workers=4, drop_last=True)
     dload_train_vbnorm = DataLoader(dset_train, batch_size=args.vbnorm_batch_size, shuffle=False, num_workers=4, drop_last=True)
     dload_train_labeled = DataLoader(dset_train_labeled, batch_size=args.batch_size, shuffle=True, num_workers=4, drop_last=True)
     dload_train_labeled = cycle(dload_train_labeled)
     dload_train_labeled_static = DataLoader(dset_train_labeled, batch_size=args.batch_size, shuffle=False, num_workers=4, drop_last=True)
     dload_train_labeled_static = cycle(dload_train_labeled_static)
-    dset_test = dataset_fn(False, transform_test)
+    dset_test = registry.view(False, transform=transform_test)
     dload_valid = DataLoader(dset_valid, batch_size=100, shuffle=False, num_workers=4, drop_last=False)
     dload_test = DataLoader(dset_test, batch_size=100, shuffle=False, num_workers=4, drop_last=False)
     return dload_train, dload_train_labeled, dload_valid,dload_test, dset_train, dset_train_labeled, dload_train_labeled_static, dload_train_vbnorm
 
 
 def get_sample_q(args, device):
+    sgld_update = sgld.get_sgld_update(args.compile_sgld)
+
     def sample_p_0(replay_buffer, bs, y=None, momentum_buffer=None, data=None):
         if len(replay_buffer) == 0:
             return init_random(args, bs), []
@@ -607,7 +579,6 @@ def get_sample_q(args, device):
         """this func takes in replay_buffer now so we have the option to sample from
         scratch (i.e. replay_buffer==[]).  See test_wrn_ebm.py for example.
         """
-        f.eval()
         # get batch size
         bs = args.batch_size if y is None else y.size(0)
         # generate initial samples and buffer inds of those samples (if buffer is used)
@@ -616,43 +587,20 @@ def get_sample_q(args, device):
         else:
             init_sample, buffer_inds = sample_p_0(replay_buffer, bs=bs, y=y,
                                                   momentum_buffer=momentum_buffer, data=data)
-        x_k = t.autograd.Variable(init_sample, requires_grad=True)
         # sgld
+        # Note f_prime is log sum exp whereas our energy function is neg log sum exp
+        # So the steps are ascent on f, i.e. descent on the energy
+        momentum = None
         if momentum_buffer is not None:
             momentum = momentum_buffer[buffer_inds].to(device)
-        for k in range(n_steps):
-            f_prime = t.autograd.grad(f(x_k, y=y).sum(), [x_k], retain_graph=True)[0]
-            # print(t.sum(t.abs(f_prime)))
-            # Note f_prime is log sum exp whereas our energy function is neg log sum exp
-            # So the reason our steps were positive before was it was minus a negative
-            neg_f_prime = -f_prime
-            # This negative f prime is the gradient of the energy function, which we are taking steps
-            # in descent with respect to.
-            # x_k.data += args.sgld_lr * f_prime + args.sgld_std * t.randn_like(x_k)
-            if momentum_buffer is not None:
-                # Modification to usual momentum to "conserve energy" which should help for sampling
-                momentum = (args.sgld_momentum * momentum + (1-args.sgld_momentum) * f_prime)
-                x_k.data += args.sgld_lr * momentum
-                # No noise with momentum right now but can do so if we want by
-                # unindenting the line 3 lines below
-            else:
-                # old = x_k.data + 0.0 # +0.0 breaks a reference, so it's now a copy instead of a reference
-                # new = x_k.data + args.sgld_lr * f_prime
-                x_k.data += args.sgld_lr * f_prime
-                # print("---")
-                # print(args.sgld_lr * f_prime)
-                # print(x_k.data)
-                # new2 = x_k.data
-                # print(t.sum(t.abs(args.sgld_lr * f_prime)))
-                # print(t.sum(t.abs(old)-t.abs(new)))
-                # print(t.sum(t.abs(old)-t.abs(new2)))
-                x_k.data += args.sgld_std * t.randn_like(x_k)
+        with sgld.sampling_mode(f):
+            x_k = sgld.sgld_chain(lambda x: f(x, y=y), init_sample, n_steps, args.sgld_lr, args.sgld_std,
+                                  momentum=momentum, sgld_momentum=args.sgld_momentum, update_fn=sgld_update)
 
-        f.train()
         if args.optim_sgld:
             final_samples = replay_buffer[buffer_inds].to(device).detach()
         else:
-            final_samples = x_k.detach()
+            final_samples = x_k
         if momentum_buffer is not None:
             momentum_buffer[buffer_inds] = momentum.cpu()
 
@@ -1229,7 +1177,7 @@ def main(args):
             if args.vat:
 
                 if args.eval_mode_except_clf:
-                    f.train()
+                    sgld.set_stats_frozen(f, False)
 
                 optim.zero_grad()
                 vat_loss = VATLoss(xi=10.0, eps=args.vat_eps, ip=1)
@@ -1249,7 +1197,7 @@ def main(args):
                 optim.step()
 
                 if args.eval_mode_except_clf:
-                    f.eval()
+                    sgld.set_stats_frozen(f, True)
 
                 cur_iter += 1
 
@@ -1336,7 +1284,7 @@ def main(args):
 
                 if args.p_y_given_x_weight > 0:  # maximize log p(y | x)
                     if args.eval_mode_except_clf:
-                        f.train()
+                        sgld.set_stats_frozen(f, False)
 
                     logits = f.classify(x_lab)
                     l_p_y_given_x = nn.CrossEntropyLoss()(logits, y_lab)
@@ -1395,7 +1343,7 @@ def main(args):
                 optim.step()
 
                 if args.eval_mode_except_clf:
-                    f.eval()
+                    sgld.set_stats_frozen(f, True)
 
                 cur_iter += 1
 
@@ -1432,7 +1380,8 @@ def main(args):
                 # test set
                 correct, loss = eval_classification(f, dload_test, device)
                 print("Epoch {}: Test Loss {}, Test Acc {}".format(epoch, loss, correct))
-            f.train()
+            if not args.eval_mode_except_clf:
+                f.train()
 
             if args.dataset == "moons" and correct >= best_valid_acc:
                 data,labels= datasets.make_moons(args.n_moons_data, noise=0.1)
@@ -1512,6 +1461,7 @@ if __name__ == "__main__":
     parser.add_argument("--reinit_freq", type=float, default=.05)
     parser.add_argument("--sgld_lr", type=float, default=1.0)
     parser.add_argument("--sgld_std", type=float, default=1e-2)
+    parser.add_argument("--compile_sgld", action="store_true", help="Fuse the SGLD update with torch.compile (or TorchScript)")
     # logging + evaluation
     parser.add_argument("--save_dir", type=str, default='./experiment')
     parser.add_argument("--ckpt_every", type=int, default=10, help="Epochs between checkpoint save")
@@ -1554,7 +1504,9 @@ if __name__ == "__main__":
     parser.add_argument("--denoising_score_match", action="store_true", help="Use denoising score matching to train")
     parser.add_argument("--denoising_sm_sigma", type=float, default=0.1, help="Noise to add in denoising score matching")
     parser.add_argument("--leaky_relu", action="store_true", help="Use Leaky ReLU activation on NN instead of ReLU. Note CNN has leaky ReLU by default")
-    parser.add_argument("--eval_mode_except_clf", action="store_true", help="Pytorch eval mode on everything except classifier training")
+    parser.add_argument("--eval_mode_except_clf", action="store_true", help="Pytorch eval mode on everything except classifier training. "
+                        "The energy terms run with frozen norm statistics and dropout throughout training "
+                        "(sampling and epoch evaluation no longer switch the model back to train mode)")
     parser.add_argument("--use_cnn", action="store_true", help="Use CNN")
     parser.add_argument("--cnn_no_bn", action="store_true", help="No BN on CNN architecture")
     parser.add_argument("--cnn_no_dropout", action="store_true", help="No Dropout on CNN architecture")
@@ -15,6 +15,7 @@ matplotlib.use("Agg")
 import matplotlib.pyplot as plt
 import utils
 import toy_data
+from data_registry import make_loader
 import hmc
 from singular import find_extreme_singular_vectors, log_sigular_values_sum_bound
 TOY_DSETS = ("moons", "circles", "8gaussians", "pinwheel", "2spirals", "checkerboard", "rings", "swissroll")
@@ -582,7 +583,7 @@ def get_data(args):
         data = torch.from_numpy(data).float()
         labels = torch.from_numpy(labels).long()
         dset = TensorDataset(data, labels)
-        dload = DataLoader(dset, args.batch_size, True, drop_last=True)
+        dload = make_loader(dset, args.batch_size, shuffle=True, drop_last=True, num_workers=args.num_workers, prefetch_factor=args.prefetch_factor)
 
         sqrt = lambda x: int(torch.sqrt(torch.Tensor([x])))
         plot = lambda p, x: torchvision.utils.save_image(x, p, normalize=False, nrow=sqrt(x.size(0)))
@@ -595,8 +596,8 @@ def get_data(args):
         te_dataset = datasets.MNIST("./data", train=False,
                                     transform=transforms.Compose([transforms.ToTensor(), lambda x: x.view(-1)]),
                                     download=True)
-        tr_dload = DataLoader(tr_dataset, args.batch_size, True, drop_last=True)
-        te_dload = DataLoader(te_dataset, args.batch_size, False)
+        tr_dload = make_loader(tr_dataset, args.batch_size, shuffle=True, drop_last=True, num_workers=args.num_workers, prefetch_factor=args.prefetch_factor)
+        te_dload = make_loader(te_dataset, args.batch_size, num_workers=args.num_workers, prefetch_factor=args.prefetch_factor)
 
         sqrt = lambda x: int(torch.sqrt(torch.Tensor([x])))
         plot = lambda p, x: torchvision.utils.save_image(x, p, normalize=False, nrow=sqrt(x.size(0)))
@@ -613,8 +614,8 @@ def get_data(args):
                                     transform=transforms.Compose([transforms.ToTensor(),
                                                                   lambda x: 2 * x - 1]),
                                     download=True)
-        tr_dload = DataLoader(tr_dataset, args.batch_size, True, drop_last=True)
-        te_dload = DataLoader(te_dataset, args.batch_size, False)
+        tr_dload = make_loader(tr_dataset, args.batch_size, shuffle=True, drop_last=True, num_workers=args.num_workers, prefetch_factor=args.prefetch_factor)
+        te_dload = make_loader(te_dataset, args.batch_size, num_workers=args.num_workers, prefetch_factor=args.prefetch_factor)
         sqrt = lambda x: int(torch.sqrt(torch.Tensor([x])))
         plot = lambda p, x: torchvision.utils.save_image(.5 * x + .5, p, normalize=False, nrow=sqrt(x.size(0)))
         return tr_dload, te_dload, plot
@@ -630,8 +631,8 @@ def get_data(args):
                                     transform=transforms.Compose([transforms.ToTensor(),
                                                                   lambda x: 2 * x - 1]),
                                     download=True)
-        tr_dload = DataLoader(tr_dataset, args.batch_size, True, drop_last=True)
-        te_dload = DataLoader(te_dataset, args.batch_size, False)
+        tr_dload = make_loader(tr_dataset, args.batch_size, shuffle=True, drop_last=True, num_workers=args.num_workers, prefetch_factor=args.prefetch_factor)
+        te_dload = make_loader(te_dataset, args.batch_size, num_workers=args.num_workers, prefetch_factor=args.prefetch_factor)
         sqrt = lambda x: int(torch.sqrt(torch.Tensor([x])))
         plot = lambda p, x: torchvision.utils.save_image(.5 * x + .5, p, normalize=False, nrow=sqrt(x.size(0)))
         return tr_dload, te_dload, plot
@@ -768,6 +769,8 @@ def get_models(args):
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser("Energy Based Models and Shit")
+    parser.add_argument("--num_workers", type=int, default=0, help="DataLoader worker processes (kept alive across epochs)")
+    parser.add_argument("--prefetch_factor", type=int, default=2, help="Batches each DataLoader worker loads ahead")
     #cifar
     parser.add_argument("--dataset", type=str, default="circles")#, choices=["mnist", "moons", "circles"])
     parser.add_argument("--data_root", type=str, default="../data")
@@ -15,7 +15,6 @@
 
 import utils
 import torch as t, torch.nn as nn, torch.nn.functional as tnnF, torch.distributions as tdist
-from torch.utils.data import DataLoader, Dataset
 import torchvision as tv, torchvision.transforms as tr
 import os
 import sys
@@ -24,6 +23,10 @@ import argparse
 import numpy as np
 import wideresnet
 import json
+import sgld
+import dist_utils
+from data_registry import DatasetRegistry, get_split_inds, split_cache_path, make_loader
+from tensor_data import DevicePrefetcher, paired_batches
 # Sampling
 from tqdm import tqdm
 t.backends.cudnn.benchmark = True
@@ -34,25 +37,11 @@ n_ch = 3
 
 
 
-class DataSubset(Dataset):
-    def __init__(self, base_dataset, inds=None, size=-1):
-        self.base_dataset = base_dataset
-        if inds is None:
-            inds = np.random.choice(list(range(len(base_dataset))), size, replace=False)
-        self.inds = inds
-
-    def __getitem__(self, index):
-        base_ind = self.inds[index]
-        return self.base_dataset[base_ind]
-
-    def __len__(self):
-        return len(self.inds)
-
-
 class F(nn.Module):
-    def __init__(self, depth=28, width=2, norm=None, dropout_rate=0.0, n_classes=10):
+    def __init__(self, depth=28, width=2, norm=None, dropout_rate=0.0, n_classes=10, grad_checkpoint=False):
         super(F, self).__init__()
-        self.f = wideresnet.Wide_ResNet(depth, width, norm=norm, dropout_rate=dropout_rate)
+        self.f = wideresnet.Wide_ResNet(depth, width, norm=norm, dropout_rate=dropout_rate,
+                                        grad_checkpoint=grad_checkpoint)
         self.energy_output = nn.Linear(self.f.last_dim, 1)
         self.class_output = nn.Linear(self.f.last_dim, n_classes)
 
@@ -66,8 +55,9 @@ class F(nn.Module):
 
 
 class CCF(F):
-    def __init__(self, depth=28, width=2, norm=None, dropout_rate=0.0, n_classes=10):
-        super(CCF, self).__init__(depth, width, norm=norm, dropout_rate=dropout_rate, n_classes=n_classes)
+    def __init__(self, depth=28, width=2, norm=None, dropout_rate=0.0, n_classes=10, grad_checkpoint=False):
+        super(CCF, self).__init__(depth, width, norm=norm, dropout_rate=dropout_rate, n_classes=n_classes,
+                                  grad_checkpoint=grad_checkpoint)
 
     def forward(self, x, y=None):
         logits = self.classify(x)
@@ -109,17 +99,22 @@ def init_random(args, bs):
 
 def get_model_and_buffer(args, device, sample_q):
     model_cls = F if args.uncond else CCF
-    f = model_cls(args.depth, args.width, args.norm, dropout_rate=args.dropout_rate, n_classes=args.n_classes)
+    f = model_cls(args.depth, args.width, args.norm, dropout_rate=args.dropout_rate, n_classes=args.n_classes,
+                  grad_checkpoint=args.grad_checkpoint)
     if not args.uncond:
-        assert args.buffer_size % args.n_classes == 0, "Buffer size must be divisible by args.n_classes"
+        # also keeps each rank's shard buffer[rank::world_size] grouped by class
+        assert args.buffer_size % (args.n_classes * args.world_size) == 0, \
+            "Buffer size must be divisible by args.n_classes (times the number of ranks)"
+    assert args.buffer_size % args.world_size == 0, "Buffer size must be divisible by the number of ranks"
     if args.load_path is None:
         # make replay buffer
-        replay_buffer = init_random(args, args.buffer_size)
+        replay_buffer = init_random(args, args.buffer_size // args.world_size)
     else:
         print(f"loading model from {args.load_path}")
         ckpt_dict = t.load(args.load_path)
         f.load_state_dict(ckpt_dict["model_state_dict"])
-        replay_buffer = ckpt_dict["replay_buffer"]
+        sgld.invalidate_layers(f)
+        replay_buffer = dist_utils.shard(ckpt_dict["replay_buffer"], args.rank, args.world_size)
 
     f = f.to(device)
     return f, replay_buffer
@@ -157,49 +152,35 @@ def get_data(args):
             return tv.datasets.SVHN(root=args.data_root, transform=transform, download=True,
                                     split="train" if train else "test")
 
+    # raw splits are loaded once; every set below is an index view with its own transform
+    registry = DatasetRegistry(dataset_fn)
     # get all training inds
-    full_train = dataset_fn(True, transform_train)
-    all_inds = list(range(len(full_train)))
-    # set seed
-    np.random.seed(1234)
-    # shuffle
-    np.random.shuffle(all_inds)
-    # seperate out validation set
-    if args.n_valid is not None:
-        valid_inds, train_inds = all_inds[:args.n_valid], all_inds[args.n_valid:]
-    else:
-        valid_inds, train_inds = [], all_inds
-    train_inds = np.array(train_inds)
-    train_labeled_inds = []
-    other_inds = []
-    train_labels = np.array([full_train[ind][1] for ind in train_inds])
-    if args.labels_per_class > 0:
-        for i in range(args.n_classes):
-            print(i)
-            train_labeled_inds.extend(train_inds[train_labels == i][:args.labels_per_class])
-            other_inds.extend(train_inds[train_labels == i][args.labels_per_class:])
-    else:
-        train_labeled_inds = train_inds
-
-    dset_train = DataSubset(
-        dataset_fn(True, transform_train),
-        inds=train_inds)
-    dset_train_labeled = DataSubset(
-        dataset_fn(True, transform_train),
-        inds=train_labeled_inds)
-    dset_valid = DataSubset(
-        dataset_fn(True, transform_test),
-        inds=valid_inds)
-    dload_train = DataLoader(dset_train, batch_size=args.batch_size, shuffle=True, num_workers=4, drop_last=True)
-    dload_train_labeled = DataLoader(dset_train_labeled, batch_size=args.batch_size, shuffle=True, num_workers=4, drop_last=True)
+    full_train = registry.raw(True)
+    train_inds, valid_inds, train_labeled_inds = get_split_inds(
+        full_train, 1234, n_valid=args.n_valid, labels_per_class=args.labels_per_class, n_classes=args.n_classes,
+        cache_path=split_cache_path(args.data_root, args.dataset, 1234, args.n_valid, args.labels_per_class))
+    if args.world_size > 1:
+        # every rank trains on its own fixed, equally long slice of the (unlabeled and labeled) training set
+        assert args.labels_per_class <= 0 or args.labels_per_class >= args.world_size, \
+            "--labels_per_class must be at least the number of ranks, or some ranks get no labels of some classes"
+        train_inds = dist_utils.shard(train_inds, args.rank, args.world_size)
+        train_labeled_inds = dist_utils.shard(train_labeled_inds, args.rank, args.world_size)
+
+    dset_train = registry.view(True, train_inds, transform_train)
+    dset_train_labeled = registry.view(True, train_labeled_inds, transform_train)
+    dset_valid = registry.view(True, valid_inds, transform_test)
+    dload_train = make_loader(dset_train, batch_size=args.batch_size, shuffle=True, drop_last=True, num_workers=args.num_workers, prefetch_factor=args.prefetch_factor)
+    dload_train_labeled = make_loader(dset_train_labeled, batch_size=args.batch_size, shuffle=True, drop_last=True, num_workers=args.num_workers, prefetch_factor=args.prefetch_factor)
     dload_train_labeled = cycle(dload_train_labeled)
-    dset_test = dataset_fn(False, transform_test)
-    dload_valid = DataLoader(dset_valid, batch_size=100, shuffle=False, num_workers=4, drop_last=False)
-    dload_test = DataLoader(dset_test, batch_size=100, shuffle=False, num_workers=4, drop_last=False)
+    dset_test = registry.view(False, transform=transform_test)
+    dload_valid = make_loader(dset_valid, batch_size=100, shuffle=False, drop_last=False, num_workers=args.num_workers, prefetch_factor=args.prefetch_factor)
+    dload_test = make_loader(dset_test, batch_size=100, shuffle=False, drop_last=False, num_workers=args.num_workers, prefetch_factor=args.prefetch_factor)
     return dload_train, dload_train_labeled, dload_valid,dload_test
 
 
 def get_sample_q(args, device):
+    sgld_update = sgld.get_sgld_update(args.compile_sgld)
+
     def sample_p_0(replay_buffer, bs, y=None):
         if len(replay_buffer) == 0:
             return init_random(args, bs), []
@@ -219,18 +200,14 @@ def get_sample_q(args, device):
         """this func takes in replay_buffer now so we have the option to sample from
         scratch (i.e. replay_buffer==[]).  See test_wrn_ebm.py for example.
         """
-        f.eval()
         # get batch size
         bs = args.batch_size if y is None else y.size(0)
         # generate initial samples and buffer inds of those samples (if buffer is used)
         init_sample, buffer_inds = sample_p_0(replay_buffer, bs=bs, y=y)
-        x_k = t.autograd.Variable(init_sample, requires_grad=True)
         # sgld
-        for k in range(n_steps):
-            f_prime = t.autograd.grad(f(x_k, y=y).sum(), [x_k], retain_graph=True)[0]
-            x_k.data += args.sgld_lr * f_prime + args.sgld_std * t.randn_like(x_k)
-        f.train()
-        final_samples = x_k.detach()
+        with sgld.sampling_mode(f):
+            final_samples = sgld.sgld_chain(lambda x: f(x, y=y), init_sample, n_steps, args.sgld_lr, args.sgld_std,
+                                            update_fn=sgld_update)
         # update replay buffer
         if len(replay_buffer) > 0:
             replay_buffer[buffer_inds] = final_samples.cpu()
@@ -253,6 +230,10 @@ def eval_classification(f, dload, device):
 
 
 def checkpoint(f, buffer, tag, args, device):
+    # in distributed runs every rank has to call this: the buffer shards are gathered and rank 0 saves
+    buffer = dist_utils.gather_shards(buffer)
+    if args.rank != 0:
+        return
     f.cpu()
     ckpt_dict = {
         "model_state_dict": f.state_dict(),
@@ -263,23 +244,28 @@ def checkpoint(f, buffer, tag, args, device):
 
 
 def main(args):
-    utils.makedirs(args.save_dir)
-    with open(f'{args.save_dir}/params.txt', 'w') as f:
-        json.dump(args.__dict__, f)
-    if args.print_to_log:
-        sys.stdout = open(f'{args.save_dir}/log.txt', 'w')
+    device = dist_utils.init_distributed(args)
+    if args.rank == 0:
+        utils.makedirs(args.save_dir)
+        with open(f'{args.save_dir}/params.txt', 'w') as f:
+            json.dump(args.__dict__, f)
+        if args.print_to_log:
+            sys.stdout = open(f'{args.save_dir}/log.txt', 'w')
+    else:
+        # only rank 0 logs
+        sys.stdout = open(os.devnull, 'w')
 
-    t.manual_seed(seed)
+    # ranks draw different chains and noise; the model itself is synced from rank 0 below
+    t.manual_seed(seed + args.rank)
     if t.cuda.is_available():
-        t.cuda.manual_seed_all(seed)
+        t.cuda.manual_seed_all(seed + args.rank)
 
     # datasets
     dload_train, dload_train_labeled, dload_valid, dload_test = get_data(args)
 
-    device = t.device('cuda' if t.cuda.is_available() else 'cpu')
-
     sample_q = get_sample_q(args, device)
     f, replay_buffer = get_model_and_buffer(args, device, sample_q)
+    dist_utils.broadcast_module(f)
 
     sqrt = lambda x: int(t.sqrt(t.Tensor([x])))
     plot = lambda p, x: tv.utils.save_image(t.clamp(x, -1, 1), p, normalize=True, nrow=sqrt(x.size(0)))
@@ -299,14 +285,17 @@ def main(args):
                 new_lr = param_group['lr'] * args.decay_rate
                 param_group['lr'] = new_lr
             print("Decaying lr to {}".format(new_lr))
-        for i, (x_p_d, _) in tqdm(enumerate(dload_train)):
+        train_batches = paired_batches(dload_train, dload_train_labeled)
+        if args.prefetch:
+            # copy the next batches to the device while this iteration runs
+            train_batches = DevicePrefetcher(train_batches, device)
+        for i, (x_p_d, _, x_lab, y_lab) in tqdm(enumerate(train_batches)):
             if cur_iter <= args.warmup_iters:
                 lr = args.lr * cur_iter / float(args.warmup_iters)
                 for param_group in optim.param_groups:
                     param_group['lr'] = lr
 
             x_p_d = x_p_d.to(device)
-            x_lab, y_lab = dload_train_labeled.__next__()
             x_lab, y_lab = x_lab.to(device), y_lab.to(device)
 
             L = 0.
@@ -358,10 +347,11 @@ def main(args):
 
             optim.zero_grad()
             L.backward()
+            dist_utils.all_reduce_grads(f)
             optim.step()
             cur_iter += 1
 
-            if cur_iter % 100 == 0:
+            if cur_iter % 100 == 0 and args.rank == 0:
                 if args.plot_uncond:
                     if args.class_cond_p_x_sample:
                         assert not args.uncond, "can only draw class-conditional samples if EBM is class-cond"
@@ -384,7 +374,8 @@ def main(args):
                 # validation set
                 correct, loss = eval_classification(f, dload_valid, device)
                 print("Epoch {}: Valid Loss {}, Valid Acc {}".format(epoch, loss, correct))
-                if correct > best_valid_acc:
+                # ranks see different eval noise, so rank 0 decides for everyone
+                if dist_utils.broadcast_object(correct > best_valid_acc):
                     best_valid_acc = correct
                     print("Best Valid!: {}".format(correct))
                     checkpoint(f, replay_buffer, "best_valid_ckpt.pt", args, device)
@@ -398,8 +389,17 @@ def main(args):
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser("Energy Based Models and Shit")
+    parser.add_argument("--num_workers", type=int, default=4, help="DataLoader worker processes (kept alive across epochs)")
+    parser.add_argument("--prefetch_factor", type=int, default=2, help="Batches each DataLoader worker loads ahead")
     parser.add_argument("--dataset", type=str, default="cifar10", choices=["cifar10", "svhn", "cifar100"])
     parser.add_argument("--data_root", type=str, default="../data")
+    parser.add_argument("--prefetch", action="store_true",
+                        help="Move the next data and labeled batches to the device asynchronously")
+    parser.add_argument("--distributed", action="store_true",
+                        help="Data-parallel training over the processes started by torchrun: each rank samples "
+                             "from its own shard of the replay buffer and data, gradients are averaged")
+    parser.add_argument("--dist_backend", type=str, default=None, choices=["nccl", "gloo"],
+                        help="Process group backend for --distributed (default: nccl with GPUs, else gloo)")
     # optimization
     parser.add_argument("--lr", type=float, default=1e-4)
     parser.add_argument("--decay_epochs", nargs="+", type=int, default=[160, 180],
@@ -426,6 +426,9 @@ if __name__ == "__main__":
     # network
     parser.add_argument("--norm", type=str, default=None, choices=[None, "norm", "batch", "instance", "layer", "act"],
                         help="norm to add to weights, none works fine")
+    parser.add_argument("--grad_checkpoint", action="store_true",
+                        help="Recompute the activations of each Wide_ResNet block in the backward "
+                             "(training and SGLD) instead of storing them")
     # EBM specific
     parser.add_argument("--n_steps", type=int, default=20,
                         help="number of steps of SGLD per iteration, 100 works for short-run, 20 works for PCD")
@@ -439,6 +442,7 @@ if __name__ == "__main__":
     parser.add_argument("--reinit_freq", type=float, default=.05)
     parser.add_argument("--sgld_lr", type=float, default=1.0)
     parser.add_argument("--sgld_std", type=float, default=1e-2)
+    parser.add_argument("--compile_sgld", action="store_true", help="Fuse the SGLD update with torch.compile (or TorchScript)")
     # logging + evaluation
     parser.add_argument("--save_dir", type=str, default='./experiment')
     parser.add_argument("--ckpt_every", type=int, default=10, help="Epochs between checkpoint save")
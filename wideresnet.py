@@ -13,9 +13,12 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import contextlib
+import torch
 import torch.nn as nn
 import torch.nn.init as init
 import torch.nn.functional as F
+import torch.utils.checkpoint
 import norms
 import numpy as np
 
@@ -32,6 +35,64 @@ def conv_init(m):
         init.constant(m.bias, 0)
 
 
+def _layer_state(module):
+    # norm and dropout layers of module, with the mode and any patched forward they ran with
+    return [(m, m.training, m.__dict__.get("forward")) for m in module.modules()
+            if isinstance(m, (nn.modules.batchnorm._BatchNorm, nn.modules.dropout._DropoutNd))]
+
+
+@contextlib.contextmanager
+def _replayed_state(state):
+    """Puts the layers back into the recorded state for a recomputation, without updating
+    running statistics a second time, and restores their current state afterwards.
+    """
+    saved = [(m, m.training, m.__dict__.get("forward"), getattr(m, "momentum", None),
+              getattr(m, "num_batches_tracked", None)) for m, _, _ in state]
+    saved = [(m, training, forward, momentum, None if tracked is None else tracked.clone())
+             for m, training, forward, momentum, tracked in saved]
+    for m, training, forward in state:
+        m.training = training
+        m.__dict__.pop("forward", None)
+        if forward is not None:
+            m.forward = forward
+        if getattr(m, "running_mean", None) is not None:
+            m.momentum = 0.
+    try:
+        yield
+    finally:
+        for m, training, forward, momentum, tracked in saved:
+            m.training = training
+            m.__dict__.pop("forward", None)
+            if forward is not None:
+                m.forward = forward
+            if getattr(m, "running_mean", None) is not None:
+                m.momentum = momentum
+                if tracked is not None:
+                    m.num_batches_tracked.copy_(tracked)
+
+
+def checkpointed(fn, module, x):
+    """fn(x), the forward of module, with activation checkpointing: the activations inside are
+    dropped after the forward and recomputed during the backward, for parameter gradients as
+    well as input gradients (SGLD). The recomputation sees norm/dropout layers in the mode they
+    had in the forward (also across sampling_mode or segmented forwards) and the same dropout
+    masks, and doesn't update running statistics again.
+    """
+    if not torch.is_grad_enabled():
+        return fn(x)
+    state = _layer_state(module)
+    calls = [0]
+
+    def run(x):
+        calls[0] += 1
+        if calls[0] == 1:
+            return fn(x)
+        with _replayed_state(state):
+            return fn(x)
+
+    return torch.utils.checkpoint.checkpoint(run, x, use_reentrant=False)
+
+
 class Identity(nn.Module):
     def __init__(self, *args, **kwargs):
         super().__init__()
@@ -40,8 +101,9 @@ class Identity(nn.Module):
 
 
 class wide_basic(nn.Module):
-    def __init__(self, in_planes, planes, dropout_rate, stride=1, norm=None, leak=.2):
+    def __init__(self, in_planes, planes, dropout_rate, stride=1, norm=None, leak=.2, grad_checkpoint=False):
         super(wide_basic, self).__init__()
+        self.grad_checkpoint = grad_checkpoint
         self.lrelu = nn.LeakyReLU(leak)
         self.bn1 = get_norm(in_planes, norm)
         self.conv1 = nn.Conv2d(in_planes, planes, kernel_size=3, padding=1, bias=True)
@@ -56,6 +118,11 @@ class wide_basic(nn.Module):
             )
 
     def forward(self, x):
+        if self.grad_checkpoint:
+            return checkpointed(self._forward, self, x)
+        return self._forward(x)
+
+    def _forward(self, x):
         out = self.dropout(self.conv1(self.lrelu(self.bn1(x))))
         out = self.conv2(self.lrelu(self.bn2(out)))
         out += self.shortcut(x)
@@ -78,9 +145,10 @@ def get_norm(n_filters, norm):
 
 class Wide_ResNet(nn.Module):
     def __init__(self, depth, widen_factor, num_classes=10, input_channels=3,
-                 sum_pool=False, norm=None, leak=.2, dropout_rate=0.0):
+                 sum_pool=False, norm=None, leak=.2, dropout_rate=0.0, grad_checkpoint=False):
         super(Wide_ResNet, self).__init__()
         self.leak = leak
+        self.grad_checkpoint = grad_checkpoint
         self.in_planes = 16
         self.sum_pool = sum_pool
         self.norm = norm
@@ -107,7 +175,8 @@ class Wide_ResNet(nn.Module):
         layers = []
 
         for stride in strides:
-            layers.append(block(self.in_planes, planes, dropout_rate, stride, norm=self.norm))
+            layers.append(block(self.in_planes, planes, dropout_rate, stride, norm=self.norm,
+                                grad_checkpoint=self.grad_checkpoint))
             self.in_planes = planes
 
         return nn.Sequential(*layers)